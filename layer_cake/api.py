@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+from pathlib import Path
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .cache import default_root
+from .utils import digest
+
+log = logging.getLogger("cake")
+
+
+class Offline(LookupError):
+    """Raised when offline and a response isn't cached"""
+
+
+class MetadataClient:
+    """JSON client for the layer API.
+
+    Requests share one pooled session and are retried with backoff on
+    connection errors and 5xx responses. Responses are cached on disk,
+    within `ttl` seconds they are served without a request, after that
+    they are revalidated using their ETag/Last-Modified. When the API
+    can't be reached a cached response is used however old it is.
+
+    With `offline` only the cache is used.
+    """
+
+    def __init__(self, cache_dir=None, ttl=None, offline=None,
+                 timeout=(3.05, 10), retries=3, backoff=0.5, pool=10):
+        if cache_dir is None:
+            cache_dir = Path(os.environ.get("CAKE_CACHE") or
+                             default_root()) / "metadata"
+        self.cache_dir = Path(cache_dir)
+        if ttl is None:
+            ttl = float(os.environ.get("CAKE_METADATA_TTL", 300))
+        self.ttl = ttl
+        if offline is None:
+            offline = bool(os.environ.get("CAKE_OFFLINE"))
+        self.offline = offline
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool, pool_maxsize=pool,
+            max_retries=Retry(total=retries, backoff_factor=backoff,
+                              status_forcelist=(500, 502, 503, 504)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url, params=None):
+        """GET url returning the decoded JSON response.
+
+        Raises requests.RequestException if the request fails and
+        nothing is cached, `Offline` if offline and nothing is cached.
+        """
+        path = self.cache_dir / (digest([url, params]) + ".json")
+        entry = self._load(path)
+        if self.offline:
+            if entry is None:
+                raise Offline("{} is not cached".format(url))
+            return entry["data"]
+        if entry is not None and time.time() - entry["fetched"] < self.ttl:
+            log.debug("Using cached %s", url)
+            return entry["data"]
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            log.debug("Fetching %s", url)
+            response = self.session.get(url, params=params, headers=headers,
+                                        timeout=self.timeout)
+            if response.status_code != 304:
+                response.raise_for_status()
+                entry = {"data": response.json(),
+                         "etag": response.headers.get("ETag"),
+                         "last_modified": response.headers.get(
+                             "Last-Modified")}
+        except requests.RequestException:
+            if entry is None:
+                raise
+            log.warning("Unable to fetch %s, using the cached response", url)
+            return entry["data"]
+        entry["fetched"] = time.time()
+        self._store(path, entry)
+        return entry["data"]
+
+    def close(self):
+        self.session.close()
+
+    def _load(self, path):
+        try:
+            with path.open() as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, path, entry):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, str(path))
@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from .utils import digest, sync_tree
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = logging.getLogger("cake")
+
+SHA = re.compile(r"[0-9a-f]{40}")
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def default_root():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "layercake"
+
+
+def parse_size(size):
+    """Parse sizes such as 500M or 2G to a number of bytes"""
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)B?\s*", str(size).upper())
+    if not match:
+        raise ValueError("Invalid size {}".format(size))
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def format_size(size):
+    for unit in ("", "K", "M", "G"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "T"
+    return "{:.0f}{}".format(size, unit)
+
+
+def tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(str(path)):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class LayerCache:
+    """Persistent cache of fetched layers.
+
+    Each repo is kept as a bare mirror under `mirrors/` which is
+    updated with `git fetch`, and each (repo, commit, repopath) is
+    exported once under `trees/`. Checkouts reflink files from the
+    exported tree where the filesystem supports it, so a cache hit
+    needs neither the network nor (usually) a copy.
+
+    Entries are evicted least recently used first once the cache
+    grows beyond `max_size` bytes, see `prune`. The CAKE_PATH indexes
+    under `cakepath/` are entries too.
+    """
+
+    def __init__(self, root=None, max_size=None, offline=None):
+        self.root = Path(root or os.environ.get("CAKE_CACHE") or
+                         default_root())
+        if offline is None:
+            offline = bool(os.environ.get("CAKE_OFFLINE"))
+        # Only use what is already mirrored
+        self.offline = offline
+        self.max_size = parse_size(
+            max_size or os.environ.get("CAKE_CACHE_SIZE") or "2G")
+        self.mirrors = self.root / "mirrors"
+        self.trees = self.root / "trees"
+        # See cakepath.SegmentIndex
+        self.indexes = self.root / "cakepath"
+        # mirror path -> lock serializing the threads updating it
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def checkout(self, repo, target, ref=None, subpath=None, link=False):
+        """Place `subpath` of `repo` at `ref` (default the remote HEAD)
+        in `target`, which must not exist. With `link` files are hard
+        linked from the cache, see `sync_tree`.
+
+        Returns the commit checked out.
+        """
+        subpath = (subpath or "").strip("/")
+        mirror = self.mirror(repo, ref)
+        commit = self._git_output(
+            "rev-parse", "--verify", "-q",
+            "{}^{{commit}}".format(ref or "HEAD"), cwd=mirror)
+        key = digest([repo, commit, subpath])
+        tree = self.trees / key
+        if not tree.exists():
+            self._export(mirror, commit, subpath, tree)
+            self._describe(tree, repo=repo, commit=commit, repopath=subpath)
+        else:
+            log.debug("Using cached %s@%s:%s", repo, commit[:12], subpath)
+        self._used(tree)
+        source = tree / subpath if subpath else tree
+        if not source.is_dir():
+            raise OSError("Repo subpath {} invalid, unable to continue".format(
+                          subpath))
+        sync_tree(source, target, link=link)
+        return commit
+
+    def mirror(self, repo, ref=None):
+        """Return the path of the bare mirror of `repo`, cloning it or
+        fetching into it unless `ref` is a commit already present.
+
+        Only one thread or process updates a mirror at a time. When
+        offline the existing mirror is used as is.
+        """
+        path = self.mirrors / (digest(repo) + ".git")
+        if self.offline:
+            if not path.exists():
+                raise OSError("{} is not cached".format(repo))
+            self._used(path)
+            return path
+        with self._lock(path):
+            if not path.exists():
+                log.info("Mirroring %s", repo)
+                tmp = self._tmp(path)
+                self._git("clone", "-q", "--mirror", repo, str(tmp))
+                self._commit(tmp, path)
+                self._describe(path, repo=repo)
+            elif not (ref and SHA.fullmatch(ref) and self._has(path, ref)):
+                log.debug("Updating mirror of %s", repo)
+                try:
+                    self._git("fetch", "-q", "--prune", "origin", cwd=path)
+                except subprocess.CalledProcessError as e:
+                    raise OSError(
+                        "Unable to update mirror of {}, use --offline to "
+                        "build from the cache: {}".format(repo, e)) from e
+            self._used(path)
+        return path
+
+    @contextmanager
+    def _lock(self, path):
+        """Hold the lock of `path` against other threads and, through a
+        lock file beside it, other processes"""
+        with self._locks_lock:
+            lock = self._locks.setdefault(str(path), threading.Lock())
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with lock, open(str(path) + ".lock", "w") as fp:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def entries(self):
+        """List cache entries, least recently used first"""
+        entries = []
+        for kind, parent in (("mirror", self.mirrors), ("tree", self.trees)):
+            if not parent.exists():
+                continue
+            for path in parent.iterdir():
+                if not path.is_dir() or ".tmp-" in path.name:
+                    continue
+                meta = path.with_name(path.name + ".json")
+                try:
+                    info = json.loads(meta.read_text())
+                except (OSError, ValueError):
+                    info = {}
+                info.update(kind=kind, path=path,
+                            size=tree_size(path),
+                            used=path.stat().st_mtime)
+                entries.append(info)
+        if self.indexes.exists():
+            for path in self.indexes.glob("*.json"):
+                try:
+                    segment = json.loads(path.read_text())["segment"]
+                except (OSError, ValueError, KeyError, TypeError):
+                    segment = None
+                st = path.stat()
+                entries.append(dict(kind="index", path=path, segment=segment,
+                                    size=st.st_size, used=st.st_mtime))
+        entries.sort(key=lambda e: e["used"])
+        return entries
+
+    def size(self):
+        return sum(e["size"] for e in self.entries())
+
+    def prune(self, max_size=None):
+        """Evict least recently used entries until the cache is no
+        larger than `max_size` (default self.max_size). Indexes of
+        CAKE_PATH segments that no longer exist are always evicted.
+
+        Returns the evicted entries.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_size and not self._orphan(entry):
+                continue
+            self.remove(entry["path"])
+            total -= entry["size"]
+            evicted.append(entry)
+        return evicted
+
+    def remove(self, path):
+        log.debug("Evicting %s", path)
+        if path.is_dir():
+            shutil.rmtree(str(path), ignore_errors=True)
+        elif path.exists():
+            path.unlink()
+        meta = path.with_name(path.name + ".json")
+        if meta.exists():
+            meta.unlink()
+
+    def _orphan(self, entry):
+        return entry["kind"] == "index" and not (
+            entry["segment"] and os.path.isdir(entry["segment"]))
+
+    def _export(self, mirror, commit, subpath, tree):
+        tmp = self._tmp(tree)
+        cmd = ["git", "archive", "--format=tar", commit]
+        if subpath:
+            cmd += ["--", subpath]
+        proc = subprocess.Popen(cmd, cwd=str(mirror), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        error = None
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                tar.extractall(str(tmp))
+        except tarfile.TarError as e:
+            error = e
+        finally:
+            proc.stdout.close()
+            stderr = proc.stderr.read().decode("utf-8").strip()
+            proc.stderr.close()
+        if proc.wait() or error:
+            shutil.rmtree(str(tmp), ignore_errors=True)
+            raise OSError("Unable to export {} from {}: {}".format(
+                          subpath or commit, mirror, stderr or error))
+        self._commit(tmp, tree)
+
+    def _commit(self, tmp, path):
+        # Move a completed entry in place, another process might
+        # have raced us to it in which case theirs is kept
+        try:
+            tmp.rename(path)
+        except OSError:
+            shutil.rmtree(str(tmp), ignore_errors=True)
+            if not path.exists():
+                raise
+
+    def _tmp(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return Path(tempfile.mkdtemp(prefix=path.name + ".tmp-",
+                                     dir=str(path.parent)))
+
+    def _describe(self, path, **info):
+        meta = path.with_name(path.name + ".json")
+        meta.write_text(json.dumps(info, sort_keys=True))
+
+    def _used(self, path):
+        # The mtime of an entry records when it was last used
+        now = time.time()
+        os.utime(str(path), (now, now))
+
+    def _has(self, mirror, commit):
+        return subprocess.call(
+            ["git", "cat-file", "-e", "{}^{{commit}}".format(commit)],
+            cwd=str(mirror), stderr=subprocess.DEVNULL) == 0
+
+    def _git(self, *cmd, cwd=None):
+        subprocess.check_call(["git", *cmd],
+                              cwd=str(cwd) if cwd else None)
+
+    def _git_output(self, *cmd, cwd=None):
+        return subprocess.check_output(
+            ["git", *cmd], cwd=str(cwd) if cwd else None).decode(
+            "utf-8").strip()
+
+
+def cache_main(options):
+    "Inspect or prune the local layer cache"
+    cache = LayerCache(options.cache_dir, options.max_size)
+    if options.action == "prune":
+        for entry in cache.prune(0 if options.all else None):
+            print("Evicted {kind} {path}".format(**entry))
+        return
+    entries = cache.entries()
+    for entry in entries:
+        name = entry.get("repo", "")
+        if entry["kind"] == "tree":
+            name = "{}@{}:{}".format(name, entry.get("commit", "")[:12],
+                                     entry.get("repopath", ""))
+        elif entry["kind"] == "index":
+            name = entry["segment"] or ""
+        print("{:<7}{:>7}  {}  {}".format(
+            entry["kind"], format_size(entry["size"]),
+            time.strftime("%Y-%m-%d %H:%M",
+                          time.localtime(entry["used"])),
+            name))
+    print("{} in {}, limit {}".format(
+          format_size(sum(e["size"] for e in entries)),
+          cache.root, format_size(cache.max_size)))
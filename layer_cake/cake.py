@@ -5,18 +5,23 @@ import os
 import shutil
 import subprocess
 import tempfile
+import time
 
 import requests
 import yaml
 
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from io import BytesIO
 from pathlib import Path
 
 from . import dockerfile
+from .api import MetadataClient, Offline
+from .cache import LayerCache, cache_main
+from .cakepath import CakePath
 from .constants import LAYERS_HOME, VERSION
 from .disco import configure_logging
-from .utils import nested_get
+from .utils import sync_tree
 
 from docker import Client as DockerClient
 
@@ -27,17 +32,18 @@ def layer_get_metadata(
         name,
         api="http://layer-cake.io",
         apiver="api/v2",
-        apiendpoint="layers"):
+        apiendpoint="layers",
+        client=None):
     uri = "/".join([api, apiver, apiendpoint, name])
+    if client is None:
+        client = MetadataClient()
     try:
-        log.debug("Fetching Layer information %s", uri)
-        result = requests.get(uri)
-    except:
+        result = client.get(uri)
+    except (requests.RequestException, Offline, ValueError) as e:
+        log.debug("Fetching Layer information %s failed: %s", uri, e)
         result = None
-    if result and result.ok:
-        result = result.json()
-        if result.get("repo"):
-            return result
+    if isinstance(result, dict) and result.get("repo"):
+        return result
     raise ValueError("Unable to locate layer {} using {}".format(
                     name, uri))
 
@@ -46,10 +52,44 @@ def git(*cmd, **kwargs):
     return subprocess.check_call(["git", *cmd], **kwargs)
 
 
+def git_output(*cmd, **kwargs):
+    return subprocess.check_output(["git", *cmd], **kwargs).decode(
+        "utf-8").strip()
+
+
+def git_checkout(repo, target, ref=None, subpath=None):
+    """Check out a single revision of repo into target.
+
+    Only `ref` (a branch, tag or commit, default the remote HEAD) is
+    fetched, without history. With `subpath` the checkout is sparse,
+    limited to that directory, and blobs outside of it are not
+    downloaded where the server supports partial clones.
+
+    Returns the commit checked out.
+    """
+    target = Path(target)
+    target.mkdir(parents=True)
+    cwd = str(target)
+    git("init", "-q", cwd)
+    git("remote", "add", "origin", repo, cwd=cwd)
+    fetch = ["fetch", "-q", "--depth", "1"]
+    if subpath:
+        git("config", "core.sparseCheckout", "true", cwd=cwd)
+        sparse = target / ".git" / "info" / "sparse-checkout"
+        sparse.parent.mkdir(parents=True, exist_ok=True)
+        sparse.write_text("/{}/\n".format(subpath.strip("/")))
+        fetch.append("--filter=blob:none")
+    git(*fetch, "origin", ref or "HEAD", cwd=cwd)
+    git("checkout", "-q", "FETCH_HEAD", cwd=cwd)
+    return git_output("rev-parse", "HEAD", cwd=cwd)
+
+
 class Layer:
     def __init__(self, metadata):
         self.metadata = metadata
         self.dir = None
+        # The commit fetched, see fetch
+        self.commit = None
         self._config = {}
 
     @classmethod
@@ -78,7 +118,7 @@ class Layer:
     def name(self):
         return self.config['name']
 
-    def fetch(self, todir, overwrite_target=False):
+    def fetch(self, todir, overwrite_target=False, cache=None, link=False):
         repo = self.metadata['repo']
         name = self.metadata['id']
         subpath = self.metadata.get('repopath', '/')
@@ -96,15 +136,23 @@ class Layer:
                     name,
                     self.dir))
 
+        # A pinned commit makes the fetch reproducible
+        ref = self.metadata.get('commit') or self.metadata.get('ref')
+        if cache is not None:
+            self.commit = cache.checkout(repo, self.dir, ref=ref,
+                                         subpath=subpath, link=link)
+            return
+
         with tempfile.TemporaryDirectory() as td:
             d = Path(td)
             reponame = repo.split("/")[-1]
             if reponame.endswith(".git"):
                 reponame = reponame[:-4]
             target = d / reponame
-            git("clone", repo, str(target))
+            self.commit = git_checkout(repo, target, ref=ref,
+                                       subpath=subpath)
             if subpath:
-                target = d / subpath
+                target = target / subpath
                 if not target.exists() or not target.is_dir():
                     raise OSError(
                         "Repo subpath {} invalid, unable to continue".format(
@@ -112,13 +160,33 @@ class Layer:
             # XXX: this could fail across certain types of mounts
             target.rename(self.dir)
 
-    def install(self, layerdir):
+    def install(self, layerdir, link=False):
+        """Place the layer under layerdir and run its installer.
+
+        Files are reflinked or copied from the fetched layer, hard linked
+        when `link` is set, an existing install is updated in place
+        copying only the files that changed. The installer output is logged as it runs.
+
+        Returns the time the installer took or None without one.
+        """
         installer = self.dir / "install"
-        shutil.copytree(str(self.dir), str(layerdir / self.name))
-        if installer.exists():
-            output = subprocess.check_output(str(installer.resolve()))
-            log.info("Executed installer for %s", self.name)
-            log.debug(output.decode("utf-8"))
+        sync_tree(self.dir, layerdir / self.name, link=link)
+        if not installer.exists():
+            return None
+        start = time.monotonic()
+        proc = subprocess.Popen([str(installer.resolve())],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        with proc.stdout:
+            for line in proc.stdout:
+                log.debug("%s: %s", self.name,
+                          line.decode("utf-8", "replace").rstrip())
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode,
+                                                str(installer))
+        elapsed = time.monotonic() - start
+        log.info("Executed installer for %s in %.2fs", self.name, elapsed)
+        return elapsed
 
 
 class Cake:
@@ -127,22 +195,56 @@ class Cake:
         self.directory = Path(options.directory)
         self.force_overwrite = options.force
         self.api_endpoint = options.layer_endpoint.rstrip("/")
-        self.scan_cakepath()
+        # Number of layers fetched or installed at once
+        self.jobs = int(getattr(options, "jobs", 4) or 1)
+        # Hard link layer files rather than copy them, the installed
+        # files then share inodes with the cache and CAKE_PATH layers
+        self.link = getattr(options, "link", False)
+        offline = getattr(options, "offline", False) or None
+        self.cache = None
+        if not getattr(options, "no_cache", True):
+            self.cache = LayerCache(getattr(options, "cache_dir", None),
+                                    offline=offline)
+        # Shared by the fetch threads
+        self.client = MetadataClient(offline=offline, pool=self.jobs)
+        # layername -> names of the layers it includes
+        self.dependencies = {}
+        # Layers on CAKE_PATH are looked up by name as needed
+        self.cakepath = CakePath.from_env()
+
+    def load_layer(self, name):
+        """Construct a layer from CAKE_PATH or fetch it using the API.
+
+        This doesn't touch shared state so layers can be loaded
+        concurrently.
+        """
+        path = self.cakepath.find(name)
+        if path is not None:
+            # Construct and register a layer from the
+            # directory
+            layer = Layer.from_path(path)
+        else:
+            metadata = layer_get_metadata(name, api=self.api_endpoint,
+                                          client=self.client)
+            layer = Layer(metadata)
+            layer.fetch(self.directory, self.force_overwrite, self.cache,
+                        self.link)
+        # Parse layer.yaml here rather than when resolving
+        layer.config
+        return layer
 
     def fetch_layer(self, name, resolving):
         if resolving.get(name):
             return resolving[name]
-        layer = None
-        if name in self.cake_map:
-            # Construct and register a layer from the
-            # directory
-            layer = Layer.from_path(self.cake_map[name])
-        elif layer is None:
-            metadata = layer_get_metadata(name, api=self.api_endpoint)
-            layer = Layer(metadata)
-            layer.fetch(self.directory, self.force_overwrite)
+        layer = self.load_layer(name)
+        self.resolve_layer(name, layer, resolving)
+        return layer
+
+    def resolve_layer(self, name, layer, resolving):
         # Now create a resolving entry for any layers this includes
-        for dep in layer.config.get('layers', []):
+        deps = layer.config.get('layers', [])
+        self.dependencies[name] = list(deps)
+        for dep in deps:
             if dep not in resolving:
                 resolving[dep] = None
             # Each request implies the layer is the dep of a predecessor,
@@ -150,7 +252,6 @@ class Cake:
             # of installing it before the thing that depends on it
             resolving.move_to_end(dep, False)
         resolving[name] = layer
-        return layer
 
     def fetch_all(self):
         # This will fill out the resolving map when layers have deps they add
@@ -159,43 +260,61 @@ class Cake:
         resolving = OrderedDict([[n, None] for n in self.layer_names])
         if not self.directory.exists():
             self.directory.mkdir(parents=True)
-        while not all(resolving.values()):
-            for name, layer in resolving.items():
-                if layer is not None:
-                    continue
-                self.fetch_layer(name, resolving)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while not all(resolving.values()):
+                # Layers still unresolved don't depend on each other's
+                # contents, fetch them concurrently then resolve their
+                # deps in order
+                pending = [name for name, layer in resolving.items()
+                           if layer is None]
+                layers = list(pool.map(self.load_layer, pending))
+                for name, layer in zip(pending, layers):
+                    self.resolve_layer(name, layer, resolving)
         self.layers = resolving
 
-    def scan_cakepath(self):
-        cake_map = {}  # layername -> Path
-        CAKE_PATH = os.environ.get("CAKE_PATH", "")
-        CAKE_PATH = CAKE_PATH.split(":")
-        CAKE_PATH = [Path(p) for p in CAKE_PATH]
-        if CAKE_PATH:
-            for cake_segment in [p for p in CAKE_PATH if p.exists()]:
-                # Build a last write wins map of layer to directory information
-                # we can search for the name of the layer in this path ignoring
-                # the repo (and the repo subpath, as finding the layers.yaml in
-                # a nested structure without metadata is too intensive)
-                p = Path(cake_segment)
-                for layerdir in p.iterdir():
-                    cfg = layerdir / "layer.yaml"
-                    if layerdir.is_dir() and cfg.exists():
-                        # This appears to be a layer
-                        cfg = yaml.load(cfg.open())
-                        layername = nested_get(cfg, "layer.name")
-                        cake_map[layername] = layerdir
-
-        self.cake_map = cake_map
-        log.debug("Found local Layers %s", sorted(self.cake_map.items()))
-
     def install(self, target_dir):
+        """Install the layers, running installers concurrently (up to
+        `jobs` at once) once the layers they include are installed."""
         # There are some implicit rules used during the install
         # layer install will copy *.{schema,rules} to layerdir
-        layerdir = Path(target_dir).mkdir(
-                parents=True, exist_ok=True)
-        for layer in self.layers.values():
-            layer.install(layerdir)
+        layerdir = Path(target_dir)
+        layerdir.mkdir(parents=True, exist_ok=True)
+        # layername -> seconds its installer took
+        self.timings = {}
+        pending = OrderedDict(self.layers)
+        running = {}
+        failed = None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                for name in self.ready(pending, running):
+                    if len(running) >= self.jobs:
+                        break
+                    layer = pending.pop(name)
+                    future = pool.submit(layer.install, layerdir, self.link)
+                    running[future] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.timings[name] = future.result()
+                    except Exception as e:
+                        log.error("Installing %s failed: %s", name, e)
+                        failed = failed or e
+                if failed is not None:
+                    # Let running installers finish but start no more
+                    pending.clear()
+        if failed is not None:
+            raise failed
+
+    def ready(self, pending, running):
+        """Names of the pending layers whose includes are installed"""
+        busy = set(pending) | set(running.values())
+        ready = [name for name in pending
+                 if not busy.intersection(self.dependencies.get(name, []))]
+        if not ready and not running and pending:
+            # Layers including each other, fall back to resolution order
+            ready = [next(iter(pending))]
+        return ready
 
 
 def layer_main(options):
@@ -205,6 +324,8 @@ def layer_main(options):
         options.layer_endpoint = endpoint
     cake = Cake(options)
     cake.fetch_all()
+    if cake.cache is not None:
+        cake.cache.prune()
     if options.no_install:
         return
     cake.install(options.directory)
@@ -270,11 +391,12 @@ def search_main(options):
 
     url = "{}/api/v2/layers/".format(options.layer_endpoint)
     query = {"q": options.term}
-    result = requests.get(url, query)
-    if not result.ok:
+    client = MetadataClient(offline=options.offline or None)
+    try:
+        data = client.get(url, query)
+    except (requests.RequestException, Offline, ValueError):
         print("Unable to connect to layer endpoint")
         return
-    data = result.json()
     if options.format == "json":
         print(json.dumps(data, indent=2))
     elif options.format == "yaml":
@@ -302,6 +424,19 @@ def setup(args=None):
     layer.add_argument("-n", "--no-install", action="store_true",
                         help=("when set exit after pulling layers, "
                               "and before the install phase"))
+    layer.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of layers to fetch or install at once")
+    layer.add_argument("--offline", action="store_true",
+                        help=("Only use cached metadata and layers, "
+                              "also set by $CAKE_OFFLINE"))
+    layer.add_argument("--link", action="store_true",
+                        help=("Hard link layer files rather than copy "
+                              "them, only safe when nothing edits them"))
+    layer.add_argument("--no-cache", action="store_true",
+                        help="Fetch layers without the local layer cache")
+    layer.add_argument("--cache-dir",
+                        help=("Layer cache location, defaults to "
+                              "$CAKE_CACHE or ~/.cache/layercake"))
 
     layer.add_argument(
             "layer",
@@ -330,9 +465,24 @@ def setup(args=None):
             help="API endpoint for metadata",
             default="http://layer-cake.io")
     search.add_argument("-f", "--format", default="text", help="Options text|json|yaml")
+    search.add_argument("--offline", action="store_true",
+                        help="Only search cached results")
     search.add_argument("term", nargs="+")
     search.set_defaults(func=search_main)
 
+    cache = parsers.add_parser("cache", help=cache_main.__doc__)
+    cache.add_argument("--cache-dir",
+                       help=("Layer cache location, defaults to "
+                             "$CAKE_CACHE or ~/.cache/layercake"))
+    cache.add_argument("action", nargs="?", default="list",
+                       choices=["list", "prune"])
+    cache.add_argument("--max-size",
+                       help=("Prune to this size (e.g. 500M), defaults "
+                             "to $CAKE_CACHE_SIZE or 2G"))
+    cache.add_argument("--all", action="store_true",
+                       help="Prune every entry")
+    cache.set_defaults(func=cache_main)
+
     options = parser.parse_args(args)
     return options
 
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from pathlib import Path
+
+import yaml
+
+from .cache import default_root
+from .utils import digest, nested_get
+
+log = logging.getLogger("cake")
+
+
+class SegmentIndex:
+    """Index of the layers found in one CAKE_PATH segment.
+
+    The index maps layer name to directory and is persisted under
+    `index_dir`. It is revalidated against the mtime of the segment,
+    which changes when layers are added, removed or renamed, and of the
+    layer.yaml of an entry before it is returned. Only the layer.yaml
+    files that changed are parsed again.
+    """
+
+    def __init__(self, segment, index_dir):
+        self.segment = Path(segment)
+        self.path = Path(index_dir) / (
+            digest(str(self.segment.resolve())) + ".json")
+        self._mtime = None
+        # layer dir name -> [layer name, layer.yaml mtime]
+        self._entries = {}
+        # layer name -> layer dir name
+        self._names = {}
+        self._load()
+
+    def find(self, name):
+        """Return the directory of layer `name` or None"""
+        self.refresh()
+        dirname = self._names.get(name)
+        if dirname is not None and self._stale(dirname):
+            # layer.yaml was edited in place, it may be named otherwise now
+            self.refresh(force=True)
+            dirname = self._names.get(name)
+        return self.segment / dirname if dirname is not None else None
+
+    def layers(self):
+        """Return all of the layers as a dict of name -> directory"""
+        self.refresh(force=True)
+        return {name: self.segment / dirname
+                for name, dirname in self._names.items()}
+
+    def refresh(self, force=False):
+        """Rescan the segment if it changed since it was indexed, with
+        `force` check every layer.yaml as well."""
+        try:
+            mtime = self.segment.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime and not force:
+            return
+        entries = {}
+        if mtime is not None:
+            for layerdir in self.segment.iterdir():
+                cfg = layerdir / "layer.yaml"
+                try:
+                    cfg_mtime = cfg.stat().st_mtime_ns
+                except OSError:
+                    # Not a layer
+                    continue
+                entry = self._entries.get(layerdir.name)
+                if entry is None or entry[1] != cfg_mtime:
+                    entry = [self._parse(cfg), cfg_mtime]
+                entries[layerdir.name] = entry
+        if entries != self._entries or mtime != self._mtime:
+            self._set(mtime, entries)
+            self._store()
+
+    def _stale(self, dirname):
+        try:
+            mtime = (self.segment / dirname / "layer.yaml").stat().st_mtime_ns
+        except OSError:
+            return True
+        return self._entries[dirname][1] != mtime
+
+    def _parse(self, cfg):
+        log.debug("Indexing %s", cfg)
+        try:
+            with cfg.open() as fp:
+                return nested_get(yaml.load(fp), "layer.name")
+        except (OSError, yaml.YAMLError):
+            return None
+
+    def _set(self, mtime, entries):
+        self._mtime = mtime
+        self._entries = entries
+        # Directories are listed in arbitrary order, keep the
+        # choice between duplicate names stable
+        self._names = {}
+        for dirname in sorted(entries):
+            if entries[dirname][0]:
+                self._names.setdefault(entries[dirname][0], dirname)
+
+    def _load(self):
+        try:
+            with self.path.open() as fp:
+                data = json.load(fp)
+            if data["segment"] == str(self.segment.resolve()):
+                self._set(data["mtime"], data["entries"])
+                # Record the use for the LRU eviction of the cache
+                os.utime(str(self.path))
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _store(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(self.path.parent),
+                                       suffix=".tmp")
+            with os.fdopen(fd, "w") as fp:
+                json.dump({"segment": str(self.segment.resolve()),
+                           "mtime": self._mtime,
+                           "entries": self._entries}, fp)
+            os.replace(tmp, str(self.path))
+        except OSError as e:
+            # The index is only an optimization
+            log.debug("Unable to store index of %s: %s", self.segment, e)
+
+
+class CakePath:
+    """Name based lookup of layers on CAKE_PATH.
+
+    Later segments take precedence over earlier ones. Segments are only
+    indexed as a lookup reaches them. Lookups are serialized so layers
+    can be loaded from several threads.
+    """
+
+    def __init__(self, segments, index_dir=None):
+        if index_dir is None:
+            index_dir = Path(os.environ.get("CAKE_CACHE") or
+                             default_root()) / "cakepath"
+        self.index_dir = index_dir
+        self.segments = [Path(s) for s in segments if s]
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, index_dir=None):
+        return cls(os.environ.get("CAKE_PATH", "").split(":"), index_dir)
+
+    def index(self, segment):
+        index = self._indexes.get(segment)
+        if index is None:
+            index = self._indexes[segment] = SegmentIndex(
+                segment, self.index_dir)
+        return index
+
+    def find(self, name):
+        """Return the directory of layer `name` or None"""
+        with self._lock:
+            for segment in reversed(self.segments):
+                if not segment.is_dir():
+                    continue
+                path = self.index(segment).find(name)
+                if path is not None:
+                    return path
+        return None
+
+    def layers(self):
+        """Return every layer on the path as a dict of name -> directory"""
+        layers = {}
+        with self._lock:
+            for segment in self.segments:
+                if segment.is_dir():
+                    layers.update(self.index(segment).layers())
+        return layers
@@ -0,0 +1,201 @@
+import aiohttp
+import asyncio
+import json
+import logging
+
+from base64 import b64decode
+
+from aioconsul import Consul
+from aioconsul.exceptions import HTTPError as ConsulHTTPError
+
+from .discovery import Source
+
+log = logging.getLogger("disco")
+
+
+class ConsulSource(Source):
+    supports_watch = True
+    # Keys of the source config passed on to the client
+    client_options = ("host", "token", "consistency")
+    # Transactions aren't supported (older Consul) or are too large
+    txn_refused = (404, 405, 413)
+
+    async def connect(self):
+        # Requests share one pool of keep-alive connections
+        self._connector = aiohttp.TCPConnector(loop=self.loop)
+        self.client = Consul(loop=self.loop,
+                             **{k: v for k, v in self.config.items()
+                                if k in self.client_options})
+        # prefix -> last X-Consul-Index and keys, see watch
+        self._indexes = {}
+        self._results = {}
+        # prefix -> blocking query still in flight, kept between watch
+        # calls so only the queries that returned are sent again
+        self._queries = {}
+        # Cleared when Consul refuses a transaction, see _read_many
+        self._use_txn = True
+
+    async def disconnect(self):
+        for task in getattr(self, "_queries", {}).values():
+            task.cancel()
+        self._queries = {}
+        connector, self._connector = getattr(self, "_connector", None), None
+        if connector is not None:
+            connector.close()
+
+    def _decode(self, prefix, data):
+        if self.scope and prefix in self.scope:
+            # Consul prefixes aren't path aware, mysql matches mysqlx/
+            data = [item for item in data
+                    if item['Key'] == prefix or
+                    item['Key'].startswith(prefix + "/")]
+        return {
+            item['Key']: b64decode(item['Value']).decode('utf-8')
+            if item.get('Value') is not None else None
+            for item in data}
+
+    async def _read(self, prefix, **params):
+        """Recursive read of the keys under prefix, returns the
+        X-Consul-Index and the decoded keys and values."""
+        params["recurse"] = True
+        response = await self.client.request(
+                "GET", "kv/{}".format(prefix), params=params,
+                connector=self._connector)
+        index = int(response.headers.get("X-Consul-Index", 0))
+        if response.status == 404:
+            # Nothing under the prefix (yet)
+            data = []
+        elif response.status == 200:
+            data = await response.json()
+        else:
+            raise ConsulHTTPError(await response.text(), response.status)
+        return index, self._decode(prefix, data)
+
+    async def _read_txn(self, prefixes):
+        """Read the keys under several prefixes in one transaction.
+
+        Returns the X-Consul-Index and a map of prefix to keys and
+        values, or None if Consul refused the transaction (too large,
+        or not supported). Other errors are raised.
+        """
+        ops = [{"KV": {"Verb": "get-tree", "Key": prefix}}
+               for prefix in prefixes]
+        response = await self.client.request(
+                "PUT", "txn", data=json.dumps(ops),
+                connector=self._connector)
+        if response.status in self.txn_refused:
+            log.debug("Consul refused txn of %d reads: %s %s",
+                      len(ops), response.status, await response.text())
+            return None
+        if response.status != 200:
+            raise ConsulHTTPError(await response.text(), response.status)
+        index = int(response.headers.get("X-Consul-Index", 0))
+        if not index:
+            # Without an index there is nothing to block on later
+            return None
+        data = [result["KV"] for result in
+                (await response.json()).get("Results") or []]
+        return index, {prefix: self._decode(prefix, [
+                        item for item in data
+                        if item['Key'].startswith(prefix)])
+                       for prefix in prefixes}
+
+    async def _read_many(self, prefixes):
+        """Read several prefixes, batched into transactions of up to
+        txn_ops (default 64) reads when Consul accepts them and one
+        request per prefix otherwise.
+
+        Returns a map of prefix to (index, keys and values).
+        """
+        results = {}
+        size = int(self.config.get("txn_ops", 64))
+        if self._use_txn and len(prefixes) > 1:
+            for i in range(0, len(prefixes), size):
+                batch = prefixes[i:i + size]
+                result = await self._read_txn(batch)
+                if result is None:
+                    self._use_txn = False
+                    break
+                index, keys = result
+                for prefix in batch:
+                    results[prefix] = index, keys[prefix]
+        rest = [prefix for prefix in prefixes if prefix not in results]
+        reads = await asyncio.gather(*[self._read(p) for p in rest],
+                                     loop=self.loop)
+        results.update(zip(rest, reads))
+        return results
+
+    async def State(self):
+        result = {}
+        for index, keys in (await self._read_many(self.prefixes())).values():
+            result.update(keys)
+        return self._nest(result)
+
+    async def watch(self, spec=None):
+        """Follow the keys under `spec` (default the configured prefix
+        or scoped interfaces) with Consul blocking queries.
+
+        Each request blocks server side, for up to `wait` (default 5m),
+        until the X-Consul-Index moves past the last index seen. A
+        scoped source holds one such request per interface, a change
+        only re-sends the request that returned with it.
+        """
+        prefixes = self.prefixes(spec)
+        wait = self.config.get("wait", "5m")
+
+        def read(prefix):
+            return self._read(
+                    prefix, index=self._indexes[prefix], wait=wait)
+
+        for prefix in set(self._queries) - set(prefixes):
+            self._queries.pop(prefix).cancel()
+        changed = False
+        while not changed:
+            unread = [p for p in prefixes if self._indexes.get(p) is None]
+            if unread:
+                # Nothing to block on yet, read them (batched)
+                reads = (await self._read_many(unread)).items()
+            else:
+                for prefix in prefixes:
+                    if prefix not in self._queries:
+                        self._queries[prefix] = asyncio.ensure_future(
+                                read(prefix), loop=self.loop)
+                done, pending = await asyncio.wait(
+                        self._queries.values(), loop=self.loop,
+                        return_when=asyncio.FIRST_COMPLETED)
+                reads = [(prefix, self._queries.pop(prefix).result())
+                         for prefix, task in list(self._queries.items())
+                         if task in done]
+            for prefix, (index, result) in reads:
+                last = self._indexes.get(prefix)
+                if last is not None and index == last:
+                    # The wait expired without a change
+                    continue
+                # A lower index means the Consul state was reset, the
+                # next query has to start from scratch
+                self._indexes[prefix] = index if index > (last or 0) else None
+                # The index can move for writes outside the prefix
+                if prefix not in self._results or \
+                        self._results[prefix] != result:
+                    self._results[prefix] = result
+                    changed = True
+        result = {}
+        for prefix in prefixes:
+            result.update(self._results.get(prefix, {}))
+        return self._nest(result)
+
+    def _nest(self, result):
+        state = {}
+        for k, v in result.items():
+            o = state
+            if "/" in k:
+                parts = k.split("/")
+                for p in parts[:-1]:
+                    o = o.setdefault(p, {})
+                k = parts[-1]
+            o[k] = v
+        return state
+
+
+class Beacon(ConsulSource):
+    pass
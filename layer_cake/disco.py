@@ -2,12 +2,16 @@
 import argparse
 import asyncio
 import logging
-import logging.handlers
 import os
+import time
 import yaml
 
-from .constants import LAYERCAKE_DIR
-from . import reactive
+# Close enough to process start for measuring time to exec
+START = time.monotonic()
+
+from .constants import LAYERCAKE_DIR  # noqa: E402
+from . import metrics  # noqa: E402
+from . import reactive  # noqa: E402
 
 log = logging.getLogger("disco")
 
@@ -66,9 +70,11 @@ def main():
     configure_logging(options.log_level)
     config = configure_from_file(options.conf)
     config.update(configure_from_env())
+    metrics.configure(config)
     r = reactive.Reactive(config, loop=loop)
     r.find_rules()
     r.find_schemas()
+    flushed = False
     try:
         config_task = loop.create_task(r())
         loop.run_until_complete(config_task)
@@ -76,10 +82,17 @@ def main():
             # Fork/Exec cmd
             log.info("Container Configured")
             log.info("Exec {}".format(options.cmd))
+            metrics.observe("time_to_exec", time.monotonic() - START)
+            # Nothing runs after a successful exec
+            metrics.registry.flush()
+            flushed = True
             os.execvp(options.cmd[0], options.cmd)
         else:
             log.critical("Unable to configure container, see log or run with -l DEBUG")
     finally:
+        # Failed runs are the ones whose metrics matter most
+        if not flushed:
+            metrics.registry.flush()
         loop.close()
 
 if __name__ == '__main__':
@@ -1,23 +1,130 @@
 import asyncio
+import importlib
 import logging
-import os
-import yaml
+import sys
+import types
 
+from . import metrics
+from .utils import DELETED, diff, digests, nested_get
 
-from aioconsul import Consul
-from aioconsul.exceptions import HTTPError as ConsulHTTPError
-from aio_etcd import Client as EtcdClient
+log = logging.getLogger("disco")
 
-from .utils import make_hash
+# Entry point group other packages register sources under, e.g. in
+# their setup.py: entry_points={ENTRY_POINTS: ["mine = pkg.mod:Source"]}
+ENTRY_POINTS = "layer_cake.sources"
 
-log = logging.getLogger("disco")
+# Source name -> "module:class" or class. Backends (and the client
+# libraries they need) are only imported once configured, see
+# source_class.
+SOURCES = {
+    "beacon": "layer_cake.consul:Beacon",
+    "consul": "layer_cake.consul:ConsulSource",
+    "etcd": "layer_cake.etcd:Etcd",
+    "flat": "layer_cake.flatfile:FlatFile",
+}
+
+
+# Backends that used to be defined here, see _Module
+MOVED = {
+    "Beacon": "layer_cake.consul:Beacon",
+    "ConsulSource": "layer_cake.consul:ConsulSource",
+    "Etcd": "layer_cake.etcd:Etcd",
+    "FlatFile": "layer_cake.flatfile:FlatFile",
+}
+
+
+class _Module(types.ModuleType):
+    """Keeps discovery.ConsulSource and friends importable without
+    importing every backend up front. A module level __getattr__ (PEP
+    562) would need Python 3.7."""
+
+    def __getattr__(self, name):
+        if name in MOVED:
+            return _import(MOVED[name])
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+                             self.__name__, name))
+
+
+sys.modules[__name__].__class__ = _Module
+
+
+def _import(target):
+    """Import "module:attr" and return attr"""
+    module, _, attr = target.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def register_source(name, target):
+    """Register a Source class, or its "module:class" path, as `name`"""
+    SOURCES[name] = target
+
+
+def source_class(name):
+    """Return the Source class registered as `name`.
+
+    Sources registered here take precedence, other names are looked up
+    among the ENTRY_POINTS of installed packages. Either way the module
+    is only imported now.
+    """
+    target = SOURCES.get(name)
+    if target is None:
+        entry_point = _entry_points(ENTRY_POINTS).get(name)
+        if entry_point is None:
+            raise ValueError("Unknown Disco Source {!r}".format(name))
+        target = entry_point.load()
+    elif isinstance(target, str):
+        target = _import(target)
+    if not (isinstance(target, type) and issubclass(target, Source)):
+        raise ValueError("Disco Source {!r} is not a Source: {!r}".format(
+                         name, target))
+    SOURCES[name] = target
+    return target
+
+
+def _entry_points(group):
+    """Entry points of group as a dict of name -> entry point"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+        return {ep.name: ep for ep in pkg_resources.iter_entry_points(group)}
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=group)
+    else:  # Python < 3.10
+        eps = eps.get(group, [])
+    return {ep.name: ep for ep in eps}
 
 
 class Source:
-    """Interface for discovery sources"""
+    """Interface for discovery sources.
+
+    Sources are polled for their `State` every disco.interval unless
+    they set `supports_watch`, in which case `watch` is awaited in a
+    loop instead and each state it returns is learned right away. A
+    source whose data is pushed to it (by a sidecar, say) implements
+    `watch` by waiting for the next push, see PushSource.
+    """
+    # Sources implementing `watch` are followed with it rather
+    # than polled for State
+    supports_watch = False
+
     def __init__(self, config):
         self.name = config.get('name', self.__class__.__name__.lower())
         self.config = config
+        # Managed by Discover, sources are connected once and
+        # only reconnected after an error
+        self.connected = False
+        # The state last learned from this source, and the digest
+        # of each of its top level interfaces
+        self.last_state = {}
+        self.digests = {}
+        # Top level interfaces to fetch, None fetches everything under
+        # the configured prefix. Set by Discover from the loaded rules.
+        self.scope = None
+        # The loop the source runs on, set by Discover. None is the
+        # default loop.
+        self.loop = None
 
     async def connect(self):
         pass
@@ -27,6 +134,10 @@ class Source:
         Watch a source for change
         spec is a source specific way of slicing into
             their data.
+
+        Blocks until the source changes and returns the data to
+        learn, the first call returns the current state. Later calls
+        may return only the part of the state that changed.
         """
         return None
 
@@ -38,76 +149,82 @@ class Source:
         """Return current state"""
         return {}
 
+    def prefixes(self, spec=None):
+        """Key prefixes to query, spec or the configured prefix, or one
+        per interface when scoped and no prefix is configured."""
+        if spec is not None:
+            return [spec]
+        prefix = self.config.get('prefix', '')
+        if self.scope and not prefix:
+            return sorted(self.scope)
+        return [prefix]
 
-class FlatFile(Source):
-    async def connect(self):
-        self.state = yaml.load(open(self.config['file']))
+    def changes(self, state):
+        """Return the `utils.diff` of state against the state last
+        learned from this source, which state then replaces.
 
-    async def State(self):
-        return self.state
+        Only interfaces whose digest changed are diffed.
+        """
+        new = digests(state)
+        changed = {k for k in set(new) | set(self.digests)
+                   if new.get(k) != self.digests.get(k)}
+        changes = diff(
+            {k: v for k, v in self.last_state.items() if k in changed},
+            {k: v for k, v in state.items() if k in changed})
+        self.last_state = state
+        self.digests = new
+        return changes
 
 
-class ConsulSource(Source):
-    async def connect(self):
-        self.client = Consul(**self.config)
+class PushSource(Source):
+    """Base for sources handed their state rather than asked for it,
+    call `push` with each new state (from a protocol or callback
+    running on the loop)."""
+    supports_watch = True
 
-    async def State(self):
-        state = {}
-        try:
-            result = await self.client.kv.items(self.config.get('prefix', ''))
-        except ConsulHTTPError:
-            log.warn("Consul Error", exc_info=True)
-            return state
-        for k, v in result.items():
-            o = state
-            if "/" in k:
-                parts = k.split("/")
-                for p in parts[:-1]:
-                    o = o.setdefault(p, {})
-                k = parts[-1]
-            o[k] = v
-        return state
-
-
-class Etcd(Source):
-    async def connect(self):
-        self.config['port'] = int(self.config.get('port', 4001))
-        self.client = EtcdClient(**self.config)
+    def __init__(self, config):
+        super().__init__(config)
+        self.state = {}
+        self._pushed = None
 
-    async def State(self):
-        state = {}
-        try:
-            result = await self.client.read(
-                    self.config.get("prefix", ""),
-                    recursive=True)
-        # XXX: fix exc
-        except Exception as e:
-            log.warn("Etcd Error %s", e, exc_info=True)
-        for leaf in result.leaves:
-            o = state
-            if not leaf or not leaf.key:
-                continue
-            if "/" in leaf.key:
-                parts = [p for p in leaf.key.split("/") if p]
-                for p in parts[:-1]:
-                    o = o.setdefault(p, {})
-                k = parts[-1]
-            o[k] = leaf.value
-        return state
+    def push(self, state):
+        self.state = state
+        if self._pushed is not None:
+            self._pushed.set()
 
+    async def State(self):
+        return self.state
 
-class Beacon(ConsulSource):
-    pass
+    async def watch(self, spec=None):
+        # The first call returns the current state, later ones wait
+        # for a push
+        if self._pushed is None:
+            self._pushed = asyncio.Event(loop=self.loop)
+            return self.state
+        await self._pushed.wait()
+        self._pushed.clear()
+        return self.state
 
 
 class Discover:
-    def __init__(self, config=None, loop=None):
+    # Upper bound in seconds on the delay before reconnecting a
+    # failing source
+    max_backoff = 60
+
+    def __init__(self, config=None, loop=None, interfaces=None):
         self.loop = loop or asyncio.get_event_loop()
         self.config = config or {}
+        # Top level interfaces referenced by rules and schemas, sources
+        # only fetch these. None fetches everything.
+        self.interfaces = set(interfaces) if interfaces else None
+        self.interval = float(nested_get(self.config, "disco.interval", 1))
         self.sources = []
         self.schema = []
-        self._hashes = {}  # source -> data_hash or None
+        self._failures = {}  # source -> consecutive failures
+        self._retry = {}  # source -> loop time to reconnect after
+        self._watches = []  # tasks following watchable sources
         self._running = False
+        self._stopped = asyncio.Event(loop=self.loop)
         self.configure()
 
     def configure(self):
@@ -116,47 +233,178 @@ class Discover:
                 # Used to configure main application
                 continue
             if source == "beacon":
-                scls = ConsulSource
                 self.config[source].setdefault('name', 'beacon')
-            elif source == "consul":
-                scls = ConsulSource
-            elif source == "etcd":
-                scls = Etcd
-            elif source == "flat":
-                scls = FlatFile
-            else:
-                raise ValueError("Unknown Disco Source {!r}".format(source))
+            scls = source_class(source)
             self.add_source(scls(self.config[source]))
 
     def add_source(self, source):
+        source.scope = self.interfaces
+        source.loop = self.loop
         self.sources.append(source)
 
     def add_schema(self, schema):
         pass
 
-    async def populate(self, knowledge):
-        """Populate knowledge base with current state from all sources"""
-        for source in self.sources:
-            await source.connect()
-            state = await source.State()
-            existing_hash = self._hashes.get(source.name, None)
-            cur_hash = make_hash(state)
-            if existing_hash != cur_hash:
-                # Only show keys here as secrets are in the data
-                log.debug("Learn {} from {}".format(
-                    sorted(state.keys()),
-                    source.name))
-                knowledge.update(state)
-                self._hashes[source.name] = cur_hash
+    def learn(self, source, state, knowledge):
+        """Update knowledge with what changed in the state of source"""
+        changes = source.changes(state)
+        if not changes:
+            return
+        # Only show keys here as secrets are in the data
+        log.debug("Learn {} from {}".format(
+            sorted({path[0] for path, value in changes}),
+            source.name))
+        with metrics.timer("knowledge_merge", source=source.name):
+            knowledge.apply_diff(self.resolve(source, changes))
+
+    def resolve(self, source, changes):
+        """Apply source precedence to the changes of source.
+
+        Later sources win, so changes to paths they provide are
+        dropped. A removed path falls back to the value of the
+        last earlier source still providing it.
+        """
+        if source in self.sources:
+            i = self.sources.index(source)
+        else:
+            i = len(self.sources)
+        earlier, later = self.sources[:i], self.sources[i + 1:]
+        resolved = []
+        for path, value in changes:
+            if any(nested_get(s.last_state, path, DELETED) is not DELETED
+                   for s in later):
+                continue
+            if value is DELETED:
+                for s in reversed(earlier):
+                    value = nested_get(s.last_state, path, DELETED)
+                    if value is not DELETED:
+                        break
+            resolved.append((path, value))
+        return resolved
+
+    async def connect(self, source):
+        """Connect source unless it is already connected"""
+        if not source.connected:
+            with metrics.timer("source_connect", source=source.name):
+                await source.connect()
+            source.connected = True
+            log.debug("Connected to %s", source.name)
+
+    async def failed(self, source):
+        """Disconnect a failing source, returning the delay before
+        it should be reconnected. The delay doubles with each
+        consecutive failure up to max_backoff."""
+        metrics.incr("source_errors", source=source.name)
+        failures = self._failures.get(source.name, 0) + 1
+        self._failures[source.name] = failures
+        delay = min(self.interval * 2 ** (failures - 1), self.max_backoff)
+        self._retry[source.name] = self.loop.time() + delay
+        log.warn("Source %s failed, reconnecting in %.1fs",
+                 source.name, delay, exc_info=True)
+        source.connected = False
+        try:
+            await source.disconnect()
+        except Exception:
+            log.debug("Error disconnecting %s", source.name, exc_info=True)
+        return delay
+
+    def recovered(self, source):
+        self._failures.pop(source.name, None)
+        self._retry.pop(source.name, None)
+
+    def timeout(self, source):
+        """Seconds a single poll of source may take"""
+        return float(source.config.get(
+            "timeout", nested_get(self.config, "disco.timeout", 10)))
+
+    async def poll(self, source):
+        """Return the current state of source or None on failure"""
+        async def state():
+            await self.connect(source)
+            with metrics.timer("source_state", source=source.name):
+                return await source.State()
+
+        try:
+            result = await asyncio.wait_for(
+                    state(), self.timeout(source), loop=self.loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await self.failed(source)
+            return None
+        self.recovered(source)
+        return result
+
+    async def populate(self, knowledge, sources=None):
+        """Populate knowledge base with current state from all sources
+
+        Sources are polled concurrently, their states are then learned
+        in the configured order so later sources take precedence.
+        """
+        now = self.loop.time()
+        sources = [source for source in sources or self.sources
+                   if self._retry.get(source.name, 0) <= now]
+        states = await asyncio.gather(
+                *[self.poll(source) for source in sources],
+                loop=self.loop)
+        for source, state in zip(sources, states):
+            if state is not None:
+                self.learn(source, state, knowledge)
+
+    async def sleep(self, delay):
+        """Sleep for delay seconds or until shutdown"""
+        try:
+            await asyncio.wait_for(self._stopped.wait(), delay,
+                                   loop=self.loop)
+        except asyncio.TimeoutError:
+            pass
+
+    async def follow(self, source, knowledge):
+        """Learn from a watchable source each time it reports a change"""
+        async def initial():
+            await self.connect(source)
+            with metrics.timer("source_state", source=source.name):
+                return await source.watch(None)
+
+        while self._running:
+            try:
+                if source.connected:
+                    state = await source.watch(None)
+                else:
+                    # Connecting and the first read answer right away
+                    # and may hang like a poll, only later reads block
+                    state = await asyncio.wait_for(
+                            initial(), self.timeout(source), loop=self.loop)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await self.sleep(await self.failed(source))
+                continue
+            self.recovered(source)
+            self.learn(source, state, knowledge)
 
     async def watch(self, knowledge):
         self._running = True
+        self._stopped.clear()
+        polled = []
+        for source in self.sources:
+            if source.supports_watch:
+                self._watches.append(self.loop.create_task(
+                    self.follow(source, knowledge)))
+            else:
+                polled.append(source)
         while self._running:
-            await self.populate(knowledge)
-            await asyncio.sleep(float(self.config.get("interval", 1.0)),
-                                loop=self.loop)
+            if polled:
+                await self.populate(knowledge, polled)
+            await self.sleep(self.interval)
 
     async def shutdown(self):
         self._running = False
+        self._stopped.set()
+        for task in self._watches:
+            task.cancel()
+        self._watches = []
         for source in self.sources:
-            await source.disconnect()
+            if source.connected:
+                source.connected = False
+                await source.disconnect()
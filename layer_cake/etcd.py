@@ -0,0 +1,155 @@
+import asyncio
+import logging
+
+from aio_etcd import Client as EtcdClient
+from aio_etcd import EtcdEventIndexCleared, EtcdKeyNotFound
+
+from .discovery import Source
+from .utils import DELETED, digest
+
+log = logging.getLogger("disco")
+
+
+class Etcd(Source):
+    supports_watch = True
+    # Keys of the source config passed on to the client
+    client_options = ("host", "port", "protocol", "cert", "ca_cert",
+                      "username", "password", "allow_reconnect",
+                      "version_prefix")
+
+    async def connect(self):
+        self.config['port'] = int(self.config.get('port', 4001))
+        self.client = EtcdClient(loop=self.loop,
+                                 **{k: v for k, v in self.config.items()
+                                    if k in self.client_options})
+        self.state = None
+        # prefix -> index to watch it from and the watch in flight, kept
+        # between watch calls
+        self._indexes = {}
+        self._watches = {}
+        self._changes = None
+
+    async def disconnect(self):
+        self._cancel()
+        client, self.client = getattr(self, "client", None), None
+        if client is not None:
+            client.close()
+
+    def _cancel(self):
+        for task in getattr(self, "_watches", {}).values():
+            task.cancel()
+        self._watches = {}
+
+    async def _read(self, prefix):
+        """Recursive read of prefix, returns its leaves and the etcd
+        index (X-Etcd-Index) the read reflects"""
+        try:
+            result = await self.client.read(prefix, recursive=True)
+        except EtcdKeyNotFound as e:
+            return [], (getattr(e, "payload", None) or {}).get("index")
+        return [leaf for leaf in result.leaves if leaf], result.etcd_index
+
+    async def State(self):
+        reads = await asyncio.gather(
+                *[self._read(prefix) for prefix in self.prefixes()],
+                loop=self.loop)
+        return self._nest([leaf for leaves, index in reads
+                           for leaf in leaves])
+
+    async def watch(self, spec=None):
+        """Follow the keys under `spec` (default the configured prefix
+        or scoped interfaces).
+
+        The first call reads the whole tree, later calls wait for the
+        next change and apply only the leaf that changed. A scoped
+        source holds one recursive watch per interface.
+        """
+        prefixes = self.prefixes(spec)
+        if self.state is None:
+            self._cancel()
+            reads = await asyncio.gather(
+                    *[self._read(prefix) for prefix in prefixes],
+                    loop=self.loop)
+            self.state = self._nest([leaf for leaves, index in reads
+                                     for leaf in leaves])
+            # Later changes have a higher index than the etcd index of
+            # the read, however long ago the data itself last changed
+            self._indexes = {prefix: index + 1 if index else None
+                             for prefix, (leaves, index) in zip(prefixes,
+                                                                reads)}
+            return self.state
+
+        for prefix in set(self._watches) - set(prefixes):
+            self._watches.pop(prefix).cancel()
+        while True:
+            for prefix in prefixes:
+                if prefix not in self._watches:
+                    self._watches[prefix] = asyncio.ensure_future(
+                            self.client.watch(
+                                prefix, index=self._indexes.get(prefix),
+                                recursive=True), loop=self.loop)
+            done, pending = await asyncio.wait(
+                    self._watches.values(), loop=self.loop,
+                    return_when=asyncio.FIRST_COMPLETED)
+            # One event at a time, other finished watches are picked up
+            # by the next call
+            prefix = next(p for p, task in self._watches.items()
+                          if task in done)
+            try:
+                result = self._watches.pop(prefix).result()
+            except EtcdEventIndexCleared:
+                # etcd no longer has the events since our index, start
+                # over from a full read
+                log.debug("Etcd history cleared, rereading %s", prefixes)
+                self.state = None
+                return await self.watch(spec)
+            if result.modifiedIndex:
+                self._indexes[prefix] = result.modifiedIndex + 1
+            parts = self._parts(result.key)
+            deleted = result.action in ("delete", "expire", "compareAndDelete")
+            if not parts or (result.dir and not deleted):
+                continue
+            break
+        path = tuple(parts)
+        o = self.state
+        if deleted:
+            for p in parts[:-1]:
+                o = o.get(p, {})
+            o.pop(parts[-1], None)
+            self._changes = [(path, DELETED)]
+        else:
+            for p in parts[:-1]:
+                o = o.setdefault(p, {})
+            o[parts[-1]] = result.value
+            self._changes = [(path, result.value)]
+        return self.state
+
+    def changes(self, state):
+        # Events already say what changed, no need to diff the tree
+        if self._changes is None or state is not self.last_state:
+            return super().changes(state)
+        changes, self._changes = self._changes, None
+        for interface in {path[0] for path, value in changes}:
+            if interface in state:
+                self.digests[interface] = digest(state[interface])
+            else:
+                self.digests.pop(interface, None)
+        return changes
+
+    @staticmethod
+    def _parts(key):
+        return [p for p in (key or "").split("/") if p]
+
+    def _nest(self, leaves):
+        state = {}
+        for leaf in leaves:
+            if not leaf or leaf.dir:
+                continue
+            parts = self._parts(leaf.key)
+            if not parts:
+                continue
+            o = state
+            for p in parts[:-1]:
+                o = o.setdefault(p, {})
+            o[parts[-1]] = leaf.value
+        return state
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import struct
+import yaml
+
+from .discovery import Source
+from .utils import deepmerge
+
+log = logging.getLogger("disco")
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# Whole files only, no IN_MODIFY or IN_CREATE so a file being written is
+# only looked at once it is closed (or renamed into place)
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# The watched directory itself went away
+LOST_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# Files read from a directory
+EXTENSIONS = (".yaml", ".yml", ".json")
+
+
+class Inotify:
+    """Minimal non blocking inotify watch of one directory"""
+
+    def __init__(self, path, mask=WATCH_MASK):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch", path)
+
+    def read(self):
+        """Pending events as a list of (mask, name)"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def inotify(path):
+    """An Inotify watch of path or None where inotify isn't available"""
+    try:
+        return Inotify(path)
+    except (AttributeError, OSError):
+        # No inotify (not Linux) or out of watches
+        log.debug("Unable to watch %s with inotify, polling it", path,
+                  exc_info=True)
+        return None
+
+
+class FlatFile(Source):
+    """YAML from `file`, either one file or a directory of .yaml (.yml,
+    .json) files merged in name order.
+
+    Files are only parsed again when their mtime, size or inode change.
+    Changes are picked up through inotify on the containing directory,
+    so files replaced by a rename are followed, or by checking each
+    file every `interval` seconds where inotify isn't available.
+    """
+    supports_watch = True
+
+    async def connect(self):
+        self.path = self.config['file']
+        self.state = None
+        # path -> (mtime, size, inode) and parsed data of each file
+        self._stats = {}
+        self._parsed = {}
+        self._loop = self.loop or asyncio.get_event_loop()
+        self._changed = asyncio.Event(loop=self._loop)
+        self._lost = False
+        self._watched = False
+        # Watch before the first read so no change is missed
+        directory = self.path if os.path.isdir(self.path) else \
+            os.path.dirname(os.path.abspath(self.path))
+        self._inotify = inotify(directory)
+        if self._inotify is not None:
+            self._loop.add_reader(self._inotify.fd, self._readable)
+
+    async def disconnect(self):
+        watch, self._inotify = getattr(self, "_inotify", None), None
+        if watch is not None:
+            self._loop.remove_reader(watch.fd)
+            watch.close()
+
+    def _readable(self):
+        for mask, name in self._inotify.read():
+            if mask & LOST_MASK:
+                self._lost = True
+        self._changed.set()
+
+    def files(self):
+        if not os.path.isdir(self.path):
+            return [self.path]
+        return [os.path.join(self.path, name)
+                for name in sorted(os.listdir(self.path))
+                if name.endswith(EXTENSIONS) and not name.startswith(".")]
+
+    def _parse(self, path):
+        with open(path) as fp:
+            data = yaml.load(fp) or {}
+        if not isinstance(data, dict):
+            log.warning("Ignoring %s, expected a mapping not %s", path,
+                        type(data).__name__)
+            return {}
+        return data
+
+    def scan(self):
+        """Parse the files that changed since the last scan, returning
+        True when the state changed"""
+        paths = self.files()
+        changed = set(self._stats) - set(paths)
+        for path in changed:
+            del self._stats[path]
+            del self._parsed[path]
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                if path == self.path:
+                    raise
+                # Removed since it was listed
+                if path in self._stats:
+                    del self._stats[path]
+                    del self._parsed[path]
+                    changed.add(path)
+                continue
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+            if self._stats.get(path) != stat:
+                log.debug("Parsing %s", path)
+                data = self._parse(path)
+                self._stats[path] = stat
+                # Touched or rewritten with the same content
+                if path not in self._parsed or self._parsed[path] != data:
+                    self._parsed[path] = data
+                    changed.add(path)
+        if self.state is not None and not changed:
+            return False
+        if len(self._parsed) == 1 and paths == [self.path]:
+            self.state = self._parsed[self.path]
+        else:
+            self.state = {}
+            for path in sorted(self._parsed):
+                deepmerge(self.state, self._parsed[path])
+        return True
+
+    async def State(self):
+        self.scan()
+        return self.state
+
+    async def watch(self, spec=None):
+        # The first call returns the current state, later ones wait
+        # for a file to change
+        if not self._watched:
+            self._watched = True
+            self.scan()
+            return self.state
+        while True:
+            if self._inotify is not None:
+                await self._changed.wait()
+                self._changed.clear()
+                if self._lost:
+                    raise OSError("Lost the watch on {}".format(self.path))
+            else:
+                await asyncio.sleep(float(self.config.get("interval", 1)),
+                                    loop=self._loop)
+            if self.scan():
+                return self.state
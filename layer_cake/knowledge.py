@@ -1,16 +1,148 @@
-import jsonschema
+import copy
 import logging
 import yaml
 
-from .utils import NestedDict
+from contextlib import contextmanager
+
+from . import metrics
+from .utils import DELETED, NestedDict, digest
 
 log = logging.getLogger("disco")
 
 
+def _jsonschema():
+    # jsonschema is slow to import and only needed once there are
+    # schemas
+    import jsonschema
+    return jsonschema
+
+
 class Knowledge(NestedDict):
     """Nested Dict like composite of knowledge from
     any available sources"""
 
+    def __init__(self, *args, **kwargs):
+        # schema name -> compiled validator, see `validator`
+        self._validators = {}
+        # top level key (or schemas.<name>) -> change counter
+        self._versions = {}
+        # key -> (change counter, digest), see `fingerprint`
+        self._digests = {}
+        # (schema, path) -> (fingerprints, result), see `is_valid`
+        self._valid = {}
+        # callables notified with the set of changed interfaces
+        self._subscribers = []
+        self._changed = set()
+        self._depth = 0
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        with self._changes():
+            super().__setitem__(key, value)
+            self._touch_path(key.split("."), value)
+
+    def apply_diff(self, changes):
+        """Apply (path, value) pairs as returned by `utils.diff`.
+
+        Only the changed leaves are written (or removed for DELETED),
+        dicts left empty by a removal are removed as well.
+        """
+        with self._changes():
+            for path, value in changes:
+                if value is DELETED:
+                    self._remove(path)
+                else:
+                    o = self
+                    for part in path[:-1]:
+                        child = dict.get(o, part)
+                        if not isinstance(child, dict):
+                            child = {}
+                            dict.__setitem__(o, part, child)
+                        o = child
+                    dict.__setitem__(o, path[-1], copy.deepcopy(value))
+                self._touch_path(path, value)
+
+    def _remove(self, path):
+        parents = [self]
+        for part in path[:-1]:
+            child = dict.get(parents[-1], part)
+            if not isinstance(child, dict):
+                return
+            parents.append(child)
+        dict.pop(parents[-1], path[-1], None)
+        for parent, part in zip(reversed(parents[:-1]),
+                                reversed(path[:-1])):
+            if dict.get(parent, part):
+                break
+            dict.pop(parent, part, None)
+
+    def _touch_path(self, parts, value):
+        if parts[0] == "schemas":
+            if len(parts) > 1:
+                self._touch_schemas([parts[1]])
+            elif isinstance(value, dict):
+                self._touch_schemas(value)
+        self._touch([parts[0]])
+
+    def update(self, other):
+        with self._changes():
+            super().update(other)
+            schemas = other.get("schemas")
+            if isinstance(schemas, dict):
+                self._touch_schemas(schemas)
+            self._touch(other)
+
+    @contextmanager
+    def _changes(self):
+        # Collect the keys touched by (possibly nested) writes and
+        # notify subscribers once the outermost write completes
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+        if self._depth or not self._changed:
+            return
+        changed, self._changed = self._changed, set()
+        for callback in list(self._subscribers):
+            callback(changed)
+
+    def _touch(self, keys):
+        for key in keys:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._changed.add(key)
+
+    def _touch_schemas(self, names):
+        for name in names:
+            self._validators.pop(name, None)
+            key = "schemas." + name
+            self._versions[key] = self._versions.get(key, 0) + 1
+        # By convention the schema name is also the interface name
+        # so a new schema can change what validates there
+        self._changed.update(names)
+
+    def subscribe(self, callback):
+        """Call `callback(interfaces)` with the set of top level keys
+        changed by each write to this object."""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def fingerprint(self, key):
+        """Return a stable digest of the top level `key` (or of the
+        schema `schemas.<name>`).
+
+        Digests are recomputed only after `key` is written through this
+        object, writes made directly to nested dicts bypass this.
+        """
+        version = self._versions.get(key, 0)
+        cached = self._digests.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, digest(self.get(key)))
+            self._digests[key] = cached
+        return cached[1]
+
     def load(self, filelike, to=None):
         data = yaml.load(filelike)
         if to:
@@ -22,22 +154,54 @@ class Knowledge(NestedDict):
         return self
 
     def load_schema(self, filelike):
-        pos = filelike.tell()
         data = yaml.load(filelike)
-        filelike.seek(pos)
         name = data['name']
-        self.load(filelike, "schemas.{}".format(name))
+        self.update({"schemas": {name: data}})
+        # Compile eagerly, the validator is then reused until
+        # this schema is reloaded
+        self.validator(name)
+
+    def validator(self, name):
+        """Return the compiled validator for schema `name`.
+
+        The schema is checked against its metaschema once, when it
+        is compiled, rather than on every validation.
+        """
+        validator = self._validators.get(name)
+        if validator is None:
+            schema = self['schemas.{}'.format(name)]
+            cls = _jsonschema().validators.validator_for(schema)
+            cls.check_schema(schema)
+            validator = cls(schema)
+            self._validators[name] = validator
+        return validator
 
     def validate(self, schema, path=None):
-        schema = self['schemas.{}'.format(schema)]
+        validator = self.validator(schema)
         obj = self[path] if path else self.map
-        jsonschema.validate(obj, schema)
-        logging.debug("Validated {}".format(schema['name']))
+        validator.validate(obj)
+        logging.debug("Validated {}".format(schema))
 
     def is_valid(self, schema, path=None):
+        """Validate as `validate` but return a bool.
+
+        Results are memoized until the data under the top level key of
+        `path` or the schema itself changes.
+        """
+        stamp = (self.fingerprint(path.split(".")[0] if path else "map"),
+                 self.fingerprint("schemas.{}".format(schema)))
+        cached = self._valid.get((schema, path))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        result = self._is_valid(schema, path)
+        self._valid[(schema, path)] = (stamp, result)
+        return result
+
+    def _is_valid(self, schema, path=None):
         try:
-            self.validate(schema, path)
-        except jsonschema.ValidationError as e:
+            with metrics.timer("validation", interface=schema):
+                self.validate(schema, path)
+        except _jsonschema().ValidationError as e:
             # Don't show the full validation error because
             # it might expose secrets to the log
             logging.info("Failed to validate {}: {}".format(schema, e.message))
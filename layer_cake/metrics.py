@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from .utils import nested_get
+
+log = logging.getLogger("disco")
+
+# Upper bounds in seconds, as Prometheus client libraries use
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def cumulative(self):
+        """(upper bound, observations <= it) pairs ending with +Inf"""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),),
+                                self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {"count": self.count, "sum": self.sum,
+                "min": self.min, "max": self.max}
+
+
+class Metrics:
+    """Counters and histograms of timings, each keyed by name and
+    labels, e.g.
+
+        with metrics.timer("source_state", source="consul"):
+            ...
+        metrics.incr("source_errors", source="consul")
+
+    Sinks see every observation as it is made, see `add_sink`, and are
+    flushed on exit with the totals.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # (name, labels) -> value, labels a sorted tuple of pairs
+        self.counters = {}
+        self.histograms = {}
+        self.sinks = []
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+        for sink in self.sinks:
+            sink.record("counter", name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+        for sink in self.sinks:
+            sink.record("timer", name, seconds, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in the block as `name`"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def as_dict(self):
+        """Totals as {"counters": [...], "timers": [...]}"""
+        return {
+            "counters": [dict(name=name, labels=dict(labels), value=value)
+                         for (name, labels), value in sorted(
+                             self.counters.items())],
+            "timers": [dict(name=name, labels=dict(labels),
+                            **histogram.as_dict())
+                       for (name, labels), histogram in sorted(
+                           self.histograms.items())]}
+
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush(self)
+            except Exception:
+                log.warn("Unable to flush metrics to %s", sink,
+                         exc_info=True)
+
+
+class Sink:
+    """Receives metrics, either as they are recorded or when flushed"""
+
+    def record(self, kind, name, value, labels):
+        pass
+
+    def flush(self, metrics):
+        pass
+
+
+class JSONLogSink(Sink):
+    """Logs the totals as a single JSON line"""
+
+    def __init__(self, logger=log):
+        self.logger = logger
+
+    def flush(self, metrics):
+        self.logger.info("metrics %s", json.dumps(metrics.as_dict(),
+                                                  sort_keys=True))
+
+
+class PrometheusSink(Sink):
+    """Writes the totals in the Prometheus text format to `path`, for
+    the node exporter textfile collector"""
+
+    def __init__(self, path, prefix="disco"):
+        self.path = path
+        self.prefix = prefix
+
+    def flush(self, metrics):
+        lines = []
+        # One TYPE line per metric family, whatever its labels
+        seen = set()
+        for (name, labels), value in sorted(metrics.counters.items()):
+            name = "{}_{}_total".format(self.prefix, name)
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE {} counter".format(name))
+            lines.append("{}{} {}".format(name, _labels(labels), value))
+        for (name, labels), histogram in sorted(metrics.histograms.items()):
+            name = "{}_{}_seconds".format(self.prefix, name)
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE {} histogram".format(name))
+            for bound, count in histogram.cumulative():
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(labels + (("le", _float(bound)),)), count))
+            lines.append("{}_sum{} {}".format(
+                name, _labels(labels), histogram.sum))
+            lines.append("{}_count{} {}".format(
+                name, _labels(labels), histogram.count))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # Written then renamed so the collector never reads a partial file
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, self.path)
+
+
+class StatsdSink(Sink):
+    """Sends each observation to statsd over UDP as it is recorded"""
+
+    def __init__(self, address="127.0.0.1:8125", prefix="disco"):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port or 8125))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, kind, name, value, labels):
+        # Labels become part of the name, statsd has no tags
+        parts = [self.prefix, name] + [
+            "{}_{}".format(k, v) for k, v in sorted(labels.items())]
+        stat = ".".join(_statsd_name(p) for p in parts if p)
+        if kind == "counter":
+            packet = "{}:{}|c".format(stat, value)
+        else:
+            packet = "{}:{:.3f}|ms".format(stat, value * 1000)
+        try:
+            self.socket.sendto(packet.encode("utf-8"), self.address)
+        except OSError:
+            # Metrics must never take disco down
+            pass
+
+    def flush(self, metrics):
+        self.socket.close()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace(
+            "\n", "\\n")) for k, v in labels) + "}"
+
+
+def _float(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def _statsd_name(value):
+    return "".join(c if c.isalnum() or c in "-_" else "_"
+                   for c in str(value))
+
+
+def configure(config, metrics=None):
+    """Add the sinks named in disco.metrics (a comma separated list of
+    json, prometheus and statsd) to metrics"""
+    metrics = metrics or registry
+    names = nested_get(config, "disco.metrics", "") or ""
+    prefix = nested_get(config, "disco.metrics_prefix", "disco")
+    for name in [n.strip() for n in str(names).split(",") if n.strip()]:
+        if name == "json":
+            sink = JSONLogSink()
+        elif name == "prometheus":
+            sink = PrometheusSink(
+                nested_get(config, "disco.metrics_path", "disco.prom"),
+                prefix)
+        elif name == "statsd":
+            sink = StatsdSink(
+                nested_get(config, "disco.statsd", "127.0.0.1:8125"), prefix)
+        else:
+            raise ValueError("Unknown metrics sink {!r}".format(name))
+        metrics.add_sink(sink)
+    return metrics
+
+
+# Shared by disco's modules
+registry = Metrics()
+incr = registry.incr
+observe = registry.observe
+timer = registry.timer
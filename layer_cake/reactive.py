@@ -2,13 +2,15 @@ import asyncio
 import json
 import logging
 import os
+import time
 import yaml
 
-from collections import ChainMap
+from collections import ChainMap, OrderedDict, defaultdict
 from pathlib import Path
 
 from . import discovery
 from . import knowledge
+from . import metrics
 from . import utils
 
 log = logging.getLogger("disco")
@@ -18,7 +20,7 @@ _marker = object()
 class Rule:
     op = all
 
-    def __init__(self, deps, command, op=None, once=True):
+    def __init__(self, deps, command, op=None, once=True, group=None):
         self._complete = False
         # Once complete the rule shouldn't be run again
         self.once = once
@@ -28,6 +30,9 @@ class Rule:
         self.cmd = command
         if op is not None:
             self.op = op
+        # Rules sharing a group (the rules file declaring them) run
+        # in order, see Reactive.run_once
+        self.group = group
         self._fail_ct = 0
 
     def __repr__(self):
@@ -36,6 +41,11 @@ class Rule:
                 " ".join(self.deps),
                 self.cmd)
 
+    @property
+    def interfaces(self):
+        """Top level interface names this rule depends on"""
+        return {d.split('.')[0] for d in self.deps}
+
     @property
     def complete(self):
         return self._complete and self.once
@@ -76,6 +86,7 @@ class Rule:
                 data = data.new_child(kb.get(interface))
 
         data = json.dumps(dict(data)).encode('utf-8')
+        start = time.monotonic()
         try:
             p = await asyncio.create_subprocess_exec(
                     self.cmd,
@@ -95,8 +106,11 @@ class Rule:
             log.warn("Handler: {} not on path: {}".format(
                 self.cmd, path))
             self.complete = False
+        # Spawn to exit
+        metrics.observe("handler", time.monotonic() - start, handler=self.cmd)
 
         if not self.complete:
+            metrics.incr("handler_failures", handler=self.cmd)
             self._fail_ct += 1
         if fail_limit and self._fail_ct >= fail_limit:
             raise RuntimeError(
@@ -118,10 +132,24 @@ class Reactive:
         self.config = config or {}
         self.loop = loop if loop else asyncio.get_event_loop()
         self.rules = []
+        # interface -> rules depending on it, rules not yet complete and
+        # rule -> position in self.rules for ordering evaluation
+        self._index = defaultdict(list)
+        self._pending = set()
+        self._order = {}
         self._path = None
         self.kb = knowledge.Knowledge()
+        # interfaces changed since the last evaluation
+        self._changed = set()
+        self._wakeup = None
+        self.kb.subscribe(self._on_change)
+
+    def _on_change(self, interfaces):
+        self._changed.update(interfaces)
+        if self._wakeup is not None:
+            self._wakeup.set()
 
-    def add_rule(self, definition, fmt):
+    def add_rule(self, definition, fmt, group=None):
         # simple rule parser
         # definition is according to fmt which an int
         # that allows format version changes
@@ -134,16 +162,38 @@ class Reactive:
         if isinstance(defs, str):
             defs = [defs]
         cmd = data["do"]
-        rule = Rule(defs, cmd, op)
+        rule = Rule(defs, cmd, op, group=group)
+        self._order[rule] = len(self.rules)
         self.rules.append(rule)
+        self._pending.add(rule)
+        for interface in rule.interfaces:
+            self._index[interface].append(rule)
         return rule
 
+    @property
+    def interfaces(self):
+        """Top level interfaces referenced by rules or schemas"""
+        return set(self._index) | set(self.kb.get("schemas", {}))
+
+    def affected(self, changed=None):
+        """Pending rules depending on any of the `changed` interfaces
+        (all pending rules when None) in the order they were added."""
+        if changed is None:
+            rules = self._pending
+        else:
+            rules = set()
+            for interface in changed:
+                rules.update(self._index.get(interface, ()))
+            rules &= self._pending
+        return sorted(rules, key=self._order.get)
+
     def load_rules(self, filelike):
         spec = yaml.load(filelike)
         fmt = spec.get("format", 1)
+        group = getattr(filelike, "name", filelike)
         # XXX: validate with schema
         for d in spec['rules']:
-            self.add_rule(d, fmt)
+            self.add_rule(d, fmt, group)
 
     def load_schema(self, filelike):
         self.kb.load_schema(filelike)
@@ -166,41 +216,125 @@ class Reactive:
             for fn in path.rglob("*.schema"):
                 self.load_schema(fn.open())
 
-    async def run_once(self):
-        complete = True
+    async def run_once(self, changed=None):
+        """Evaluate pending rules, executing the handlers of those that
+        match. When `changed` is a set of interfaces only rules depending
+        on one of them are evaluated.
+
+        With disco.max_parallel > 1 handlers of matched rules run
+        concurrently, except that rules from the same rules file still
+        run one after another in the order they were declared.
+
+        Returns True once every rule is complete.
+        """
         fail_limit = int(utils.nested_get(self.config, 'disco.fail_limit', 5))
+        max_parallel = int(utils.nested_get(
+            self.config, 'disco.max_parallel', 1))
         path = utils.nested_get(self.config, 'disco.path')
-        for rule in self.rules:
-            if rule.complete:
-                continue
-            if not rule.match(self.kb):
+        matched = []
+        for rule in self.affected(changed):
+            with metrics.timer("rule_match", rule=rule.cmd):
+                match = rule.match(self.kb)
+            if not match:
                 log.debug("rule pending %s", rule)
-                complete = False
                 continue
-            log.info("executing %s", rule)
-            try:
-                complete = await rule.execute(
-                        self.kb,
-                        path=path,
-                        fail_limit=fail_limit)
-            except RuntimeError:
-                self.shutdown()
-                complete = False
-                break
-        return complete
+            matched.append(rule)
+
+        try:
+            if max_parallel > 1:
+                await self._execute_parallel(
+                        matched, max_parallel,
+                        path=path, fail_limit=fail_limit)
+            else:
+                for rule in matched:
+                    await self._execute(
+                            rule, path=path, fail_limit=fail_limit)
+        except RuntimeError:
+            self.shutdown()
+            return False
+        return not self._pending
+
+    async def _execute(self, rule, **kwargs):
+        log.info("executing %s", rule)
+        await rule.execute(self.kb, **kwargs)
+        if rule.complete:
+            self._pending.discard(rule)
+
+    async def _execute_parallel(self, rules, max_parallel, **kwargs):
+        semaphore = asyncio.Semaphore(max_parallel, loop=self.loop)
+        groups = OrderedDict()
+        for rule in rules:
+            # Rules without a group are independent of each other
+            key = rule if rule.group is None else rule.group
+            groups.setdefault(key, []).append(rule)
+
+        # Set once a rule fails, no further rules are started
+        failed = asyncio.Event(loop=self.loop)
+
+        async def run_group(group):
+            for rule in group:
+                if failed.is_set():
+                    return
+                async with semaphore:
+                    if failed.is_set():
+                        return
+                    try:
+                        await self._execute(rule, **kwargs)
+                    except Exception:
+                        failed.set()
+                        raise
+
+        results = await asyncio.gather(
+                *[run_group(g) for g in groups.values()],
+                loop=self.loop, return_exceptions=True)
+        # Let running handlers finish before reporting a failure
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
     def shutdown(self):
         self._should_run = False
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def wait_for_change(self, timeout):
+        """Wait up to `timeout` seconds for the knowledge base to change.
+
+        Returns the set of changed interfaces or None if the timeout
+        passed without a change.
+        """
+        if timeout > 0 and not self._changed:
+            try:
+                await asyncio.wait_for(
+                        self._wakeup.wait(), timeout, loop=self.loop)
+            except asyncio.TimeoutError:
+                return None
+        self._wakeup.clear()
+        if timeout <= 0 or not self._changed:
+            return None
+        changed, self._changed = self._changed, set()
+        return changed
 
     async def run(self, discover):
         self._should_run = True
+        self._wakeup = asyncio.Event(loop=self.loop)
         interval = float(utils.nested_get(
             self.config, 'disco.interval', 1))
+        # Rules are evaluated as soon as the interfaces they depend on
+        # change, every rule is still re-evaluated each interval so
+        # failed handlers are retried.
+        changed = None
         while self._should_run:
-            complete = await self.run_once()
+            if changed is None:
+                last_pass = self.loop.time()
+                # A full pass covers whatever changed before it
+                self._changed.clear()
+                self._wakeup.clear()
+            complete = await self.run_once(changed)
             if complete:
                 break
-            await asyncio.sleep(interval, loop=self.loop)
+            changed = await self.wait_for_change(
+                last_pass + interval - self.loop.time())
 
         # Do any tear down on the discovery services
         await discover.shutdown()
@@ -208,7 +342,8 @@ class Reactive:
 
     async def __call__(self):
         # bring up the discovery task
-        d = discovery.Discover(self.config)
+        d = discovery.Discover(self.config, loop=self.loop,
+                               interfaces=self.interfaces)
         dtask = self.loop.create_task(d.watch(self.kb))
         rtask = self.loop.create_task(self.run(d))
         asyncio.wait([await dtask, await rtask])
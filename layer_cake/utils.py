@@ -1,30 +1,250 @@
 import collections
 import copy
+import json
+import os
+import shutil
+import stat
 
+from collections.abc import Mapping
 
-def freeze(o):
-    if isinstance(o, dict):
-        return frozenset({k: freeze(v) for k, v in o.items()}.items())
 
-    if isinstance(o, list):
-        return tuple([freeze(v) for v in o])
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from hashlib import blake2b
+except ImportError:  # Python < 3.6
+    blake2b = None
+    from hashlib import sha256
+
+# ioctl cloning a file's extents (a reflink), Linux btrfs/xfs
+FICLONE = 0x40049409
+
+
+def digest(o):
+    """
+    Stable hex digest of a nested structure of dicts, lists, tuples,
+    sets and scalars.
+
+    JSON compatible data is hashed as canonical JSON (sorted keys), the
+    encoder being implemented in C. Anything else (sets, bytes, mixed
+    key types) is walked in a canonical order and fed to the hash as it
+    goes. Unlike `hash` the result is the same across processes and
+    runs. As in JSON, tuples digest as lists and int keys as strings.
+    """
+    h = blake2b(digest_size=16) if blake2b else sha256()
+    try:
+        data = json.dumps(o, sort_keys=True, separators=(",", ":"),
+                          allow_nan=False)
+    except (TypeError, ValueError):
+        _feed(h.update, o)
+    else:
+        # The walk never starts with b"j", so the two can't collide
+        h.update(b"j")
+        h.update(data.encode("ascii"))
+    return h.hexdigest()
+
+
+def digests(o):
+    """Digest each top level value of dict `o`"""
+    return {k: digest(v) for k, v in o.items()}
 
-    return o
 
+def _sort_key(k):
+    return (type(k).__name__, k)
 
-def make_hash(o):
-    return hash(freeze(o))
+
+def _feed(update, o):
+    # Each value is tagged with its type, containers with
+    # their length, so distinct structures can't collide
+    if isinstance(o, Mapping):
+        update(b"d%d:" % len(o))
+        for k in sorted(o, key=_sort_key):
+            _feed(update, k)
+            _feed(update, o[k])
+    elif isinstance(o, (list, tuple)):
+        update(b"l%d:" % len(o))
+        for v in o:
+            _feed(update, v)
+    elif isinstance(o, (set, frozenset)):
+        update(b"s%d:" % len(o))
+        for d in sorted(digest(v) for v in o):
+            update(d.encode("ascii"))
+    elif isinstance(o, str):
+        o = o.encode("utf-8")
+        update(b"u%d:" % len(o))
+        update(o)
+    elif isinstance(o, bytes):
+        update(b"b%d:" % len(o))
+        update(o)
+    elif o is None or isinstance(o, bool):
+        update(b"n" if o is None else b"t" if o else b"f")
+    elif isinstance(o, int):
+        update(b"i%d;" % o)
+    elif isinstance(o, float):
+        update(b"r" + repr(o).encode("ascii") + b";")
+    else:
+        o = "{}:{!r}".format(type(o).__name__, o).encode("utf-8")
+        update(b"o%d:" % len(o))
+        update(o)
 
 
 def nested_get(dict, path, default=None, sep="."):
+    """Get a value by `sep` delimited path, or a tuple of keys"""
     o = dict
-    for part in path.split(sep):
-        if part not in o:
+    parts = path.split(sep) if isinstance(path, str) else path
+    for part in parts:
+        if not isinstance(o, Mapping) or part not in o:
             return default
         o = o[part]
     return o
 
 
+class _Deleted:
+    def __repr__(self):
+        return "DELETED"
+
+
+# Marks a removed path in the output of `diff`
+DELETED = _Deleted()
+
+
+def diff(old, new):
+    """
+    Structural diff of two nested dicts.
+
+    Returns a list of (path, value) pairs, path being a tuple of keys,
+    for every leaf added or changed in `new` and (path, DELETED) for
+    every leaf of `old` missing from `new`. Unchanged subtrees are
+    skipped with a plain equality check.
+    """
+    changes = []
+    _diff(old, new, (), changes)
+    return changes
+
+
+def _diff(old, new, path, changes):
+    for k, v in new.items():
+        if k not in old:
+            _leaves(v, path + (k,), changes)
+            continue
+        o = old[k]
+        if o == v:
+            continue
+        if isinstance(o, dict) and isinstance(v, dict) and v:
+            _diff(o, v, path + (k,), changes)
+        else:
+            _leaves(v, path + (k,), changes)
+    for k, o in old.items():
+        if k not in new:
+            _leaves(o, path + (k,), changes, DELETED)
+
+
+def _leaves(o, path, changes, value=None):
+    if isinstance(o, dict) and o:
+        for k, v in o.items():
+            _leaves(v, path + (k,), changes, value)
+    else:
+        changes.append((path, o if value is None else value))
+
+
+def sync_tree(src, dst, link=False, checksum=False):
+    """Make `dst` a copy of the tree `src`, much like rsync --delete.
+
+    Files already present in `dst` with the same size and mtime (with
+    `checksum` the same content) are left alone, others are hard
+    linked when `link` is set and possible, else reflinked where the
+    filesystem supports it, else copied. Hard linked files share their
+    inode with `src`, writing to one changes the other. Symlinks are recreated as is
+    and anything in `dst` that isn't in `src` is removed.
+    """
+    src, dst = str(src), str(dst)
+    for root, dirs, files in os.walk(src):
+        target = os.path.normpath(
+            os.path.join(dst, os.path.relpath(root, src)))
+        if os.path.lexists(target) and (os.path.islink(target) or
+                                        not os.path.isdir(target)):
+            _remove(target)
+        os.makedirs(target, exist_ok=True)
+        wanted = set(dirs) | set(files)
+        for name in os.listdir(target):
+            if name not in wanted:
+                _remove(os.path.join(target, name))
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            dest = os.path.join(target, name)
+            if os.path.islink(path):
+                value = os.readlink(path)
+                if os.path.islink(dest) and os.readlink(dest) == value:
+                    continue
+                _remove(dest)
+                os.symlink(value, dest)
+            elif name in files:
+                if _same_file(path, dest, checksum):
+                    continue
+                _remove(dest)
+                _place(path, dest, link)
+        # os.walk doesn't descend into links to directories
+        dirs[:] = [d for d in dirs
+                   if not os.path.islink(os.path.join(root, d))]
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _same_file(src, dst, checksum=False):
+    try:
+        d = os.lstat(dst)
+    except OSError:
+        return False
+    if not stat.S_ISREG(d.st_mode):
+        return False
+    s = os.stat(src)
+    if os.path.samestat(s, d):
+        return True
+    if s.st_size != d.st_size:
+        return False
+    # Whole seconds as not every filesystem keeps finer mtimes
+    if int(s.st_mtime) == int(d.st_mtime):
+        return True
+    if checksum and _file_digest(src) == _file_digest(dst):
+        shutil.copystat(src, dst)
+        return True
+    return False
+
+
+def _file_digest(path):
+    h = blake2b() if blake2b else sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def _place(src, dst, link=True):
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as s, open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            _remove(dst)
+    shutil.copy2(src, dst)
+
+
 def deepmerge(dest, src):
     """
     Deep merge of two dicts.
@@ -62,7 +282,9 @@ class NestedDict(dict):
         o = self
         for part in path.split("."):
             if part not in o:
-                raise KeyError("{} not found in {}".format(part, o))
+                # Don't format o into the message, that is costly for
+                # large dicts and a miss here is common (see deepmerge)
+                raise KeyError(path)
             o = dict.__getitem__(o, part)
         return o
 
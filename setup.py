@@ -38,5 +38,12 @@ setup(
                 'disco = layer_cake.disco:main',
                 'cake = layer_cake.cake:main',
         ],
+        # Discovery sources, other packages can add their own
+        'layer_cake.sources': [
+                'beacon = layer_cake.consul:Beacon',
+                'consul = layer_cake.consul:ConsulSource',
+                'etcd = layer_cake.etcd:Etcd',
+                'flat = layer_cake.flatfile:FlatFile',
+        ],
     },
 )
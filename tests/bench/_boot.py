@@ -0,0 +1,95 @@
+"""Run disco.main instrumented for coldstart.py
+
+    _boot.py RESULTS SPAWNED [disco arguments...]
+
+SPAWNED is the wall clock time the parent started this process. Marks
+(wall clock times) and handler timings are written as JSON to RESULTS
+just before disco execs the command, or at exit if it never does.
+"""
+import time
+BOOT = time.time()
+
+import atexit  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+
+results_path, spawned = sys.argv[1], float(sys.argv[2])
+sys.argv = ["disco"] + sys.argv[3:]
+marks = {"spawned": spawned, "boot": BOOT}
+timings = {"spawn": [], "handler": []}
+counts = {"match": 0, "matched": 0}
+
+from layer_cake import disco, reactive  # noqa: E402
+import asyncio  # noqa: E402
+marks["imported"] = time.time()
+
+
+def dump():
+    if os.path.exists(results_path):
+        return
+    with open(results_path, "w") as fp:
+        json.dump({"marks": marks, "timings": timings, "counts": counts}, fp)
+
+
+atexit.register(dump)
+
+_match = reactive.Rule.match
+
+
+def match(self, kb):
+    result = _match(self, kb)
+    counts["match"] += 1
+    if result:
+        counts["matched"] += 1
+        marks.setdefault("first_match", time.time())
+    return result
+
+
+_execute = reactive.Rule.execute
+
+
+async def execute(self, *args, **kwargs):
+    start = time.time()
+    marks.setdefault("first_handler", start)
+    try:
+        return await _execute(self, *args, **kwargs)
+    finally:
+        timings["handler"].append(time.time() - start)
+
+
+_spawn = asyncio.create_subprocess_exec
+
+
+async def spawn(*args, **kwargs):
+    start = time.time()
+    try:
+        return await _spawn(*args, **kwargs)
+    finally:
+        timings["spawn"].append(time.time() - start)
+
+
+_execvp = os.execvp
+
+
+def execvp(file, args):
+    marks["exec"] = time.time()
+    dump()
+    _execvp(file, args)
+
+
+_run = reactive.Reactive.run_once
+
+
+async def run_once(self, *args, **kwargs):
+    marks.setdefault("first_pass", time.time())
+    return await _run(self, *args, **kwargs)
+
+
+reactive.Rule.match = match
+reactive.Rule.execute = execute
+reactive.Reactive.run_once = run_once
+asyncio.create_subprocess_exec = spawn
+os.execvp = execvp
+
+disco.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Cold start benchmark for disco.
+
+Starts a local fake Consul or etcd server, runs disco (see _boot.py) with
+N rules over M interfaces against it and measures, from process start:
+
+    import        importing layer_cake.disco and its sources
+    first_match   the first rule matching
+    exec          disco calling os.execvp for the command
+    started       the command running
+
+along with the time to spawn each handler and run it. Each combination
+of the comma separated parameters is measured --repeat times, e.g.
+
+    python tests/bench/coldstart.py --source consul,etcd \\
+        --rules 1,10,100 --keys 100,10000 --interval 0.1,1 -o cold.json
+
+With --delay the interface data is only published that many seconds
+after disco starts, showing how quickly watches pick changes up.
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from common import (HERE, environ, float_list, int_list, ms, save,
+                    str_list, summarize)
+from utils import FakeConsul, FakeEtcd
+
+SCHEMA = {"type": "object",
+          "properties": {"host": {"type": "string"},
+                         "port": {"type": "string"}},
+          "required": ["host", "port"]}
+
+# Handlers run with PATH set to the disco path, stick to builtins
+HANDLER = "#!/bin/sh\nwhile read -r line; do :; done\n"
+
+# Records when the command disco execs started
+COMMAND = [sys.executable, "-c",
+           "import sys, time; open(sys.argv[1], 'w').write(repr(time.time()))"]
+
+
+def build(path, rules, interfaces):
+    """Write `rules` rules spread over `interfaces` interfaces, a schema
+    per interface and the handler they run to the disco path"""
+    for i in range(interfaces):
+        with open(os.path.join(path, "iface{}.schema".format(i)), "w") as fp:
+            yaml.safe_dump(dict(SCHEMA, name="iface{}".format(i)), fp)
+    spec = {"format": 1, "rules": [
+        {"rule": {"when": "iface{}".format(i % interfaces), "do": "handler"}}
+        for i in range(rules)]}
+    with open(os.path.join(path, "bench.rules"), "w") as fp:
+        yaml.safe_dump(spec, fp)
+    handler = os.path.join(path, "handler")
+    with open(handler, "w") as fp:
+        fp.write(HANDLER)
+    os.chmod(handler, 0o755)
+
+
+def keyspace(interfaces, keys):
+    """Interface data plus unrelated keys to make up `keys` keys"""
+    data = {}
+    for i in range(interfaces):
+        data["iface{}/host".format(i)] = "10.0.0.{}".format(i % 250)
+        data["iface{}/port".format(i)] = str(3306 + i)
+    for i in range(max(0, keys - len(data))):
+        data["other{}/key{}".format(i % 100, i)] = "x" * 32
+    return data
+
+
+def server(source, data):
+    return FakeConsul(data) if source == "consul" else FakeEtcd(data)
+
+
+def source_config(source, fake):
+    if source == "consul":
+        return {"host": fake.url}
+    return {"host": "127.0.0.1", "port": fake.port}
+
+
+def run(source, rules, interfaces, keys, interval, delay, timeout,
+        verbose=False):
+    """One cold start, returns the measurements in seconds"""
+    data = keyspace(interfaces, keys)
+    interface_keys = {k for k in data if k.startswith("iface")}
+    initial = data if not delay else {
+        k: v for k, v in data.items() if k not in interface_keys}
+    with tempfile.TemporaryDirectory() as td, \
+            server(source, initial) as fake:
+        build(td, rules, interfaces)
+        conf = os.path.join(td, "disco.conf")
+        with open(conf, "w") as fp:
+            yaml.safe_dump({"disco": {"path": td, "interval": interval},
+                            source: source_config(source, fake)}, fp)
+        results = os.path.join(td, "results.json")
+        started = os.path.join(td, "started")
+        publish = None
+        if delay:
+            publish = threading.Timer(delay, lambda: [
+                fake.put(k, data[k]) for k in sorted(interface_keys)])
+        cmd = [sys.executable, os.path.join(HERE, "_boot.py"),
+               results, repr(time.time()),
+               "-l", "DEBUG" if verbose else "WARNING",
+               "-c", conf, "--"] + COMMAND + [started]
+        if publish is not None:
+            publish.start()
+        try:
+            proc = subprocess.run(cmd, timeout=timeout, env=environ(),
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+        finally:
+            if publish is not None:
+                publish.cancel()
+        if verbose:
+            sys.stdout.write(proc.stdout.decode("utf-8", "replace"))
+        if not os.path.exists(results):
+            raise RuntimeError("disco failed to start:\n" +
+                               proc.stdout.decode("utf-8", "replace"))
+        with open(results) as fp:
+            boot = json.load(fp)
+        marks = boot["marks"]
+        if os.path.exists(started):
+            with open(started) as fp:
+                marks["started"] = float(fp.read())
+
+    def since(mark, base="spawned"):
+        if mark not in marks:
+            return None
+        return marks[mark] - marks[base]
+
+    return {"interpreter": since("boot"),
+            "import": since("imported", "boot"),
+            "first_pass": since("first_pass"),
+            "first_match": since("first_match"),
+            "first_match_after_publish": (
+                since("first_match") - delay
+                if "first_match" in marks else None),
+            "exec": since("exec"),
+            "started": since("started"),
+            "spawn": boot["timings"]["spawn"],
+            "handler": boot["timings"]["handler"],
+            "match_calls": boot["counts"]["match"],
+            "returncode": proc.returncode}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--source", type=str_list, default=["consul"],
+                        help="consul and/or etcd")
+    parser.add_argument("--rules", type=int_list, default=[1, 10, 100])
+    parser.add_argument("--interfaces", type=int_list, default=[10])
+    parser.add_argument("--keys", type=int_list, default=[100],
+                        help="Total keys in the store")
+    parser.add_argument("--interval", type=float_list, default=[1.0],
+                        help="disco.interval")
+    parser.add_argument("--delay", type=float, default=0,
+                        help="Publish interface data after this many seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("-o", "--output", help="Save results as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show disco's output")
+    options = parser.parse_args()
+
+    header = ("source", "rules", "ifaces", "keys", "interval",
+              "import", "match", "exec", "started", "spawn", "handler")
+    print("{:<7}{:>6}{:>7}{:>8}{:>9}  ".format(*header[:5]) +
+          "".join("{:>9}".format(h) for h in header[5:]) +
+          "   (ms, p50)")
+    results = []
+    for source, rules, interfaces, keys, interval in itertools.product(
+            options.source, options.rules, options.interfaces,
+            options.keys, options.interval):
+        runs = [run(source, rules, interfaces, keys, interval,
+                    options.delay, options.timeout, options.verbose)
+                for _ in range(options.repeat)]
+        summary = {name: summarize([r[name] for r in runs])
+                   for name in ("interpreter", "import", "first_pass",
+                                "first_match", "first_match_after_publish",
+                                "exec", "started")}
+        for name in ("spawn", "handler"):
+            summary[name] = summarize([t for r in runs for t in r[name]])
+        failures = sum(1 for r in runs if r["returncode"] or
+                       r["exec"] is None)
+        results.append({"source": source, "rules": rules,
+                        "interfaces": interfaces, "keys": keys,
+                        "interval": interval, "failures": failures,
+                        "summary": summary, "runs": runs})
+
+        def p50(name):
+            return ms(summary[name]["p50"] if summary[name] else None)
+        print("{:<7}{:>6}{:>7}{:>8}{:>9}  ".format(
+              source, rules, interfaces, keys, interval) +
+              "".join("{:>9}".format(p50(name)) for name in (
+                  "import", "first_match", "exec", "started",
+                  "spawn", "handler")) +
+              ("   {} failed".format(failures) if failures else ""))
+    if options.output:
+        save(options.output, "coldstart", vars(options), results)
+
+
+if __name__ == "__main__":
+    main()
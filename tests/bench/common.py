@@ -0,0 +1,95 @@
+"""Helpers shared by the benchmarks in this directory"""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(HERE))
+# The fake servers live in tests/utils.py, layer_cake in the checkout
+sys.path[:0] = [os.path.dirname(HERE), ROOT]
+
+
+def environ():
+    """Environment for subprocesses importing layer_cake from the
+    checkout"""
+    path = [ROOT] + [p for p in os.environ.get("PYTHONPATH", "").split(
+        os.pathsep) if p]
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+
+
+def percentile(samples, p):
+    """Nearest rank percentile of samples"""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = max(0, math.ceil(p / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize(samples):
+    """Latency summary of samples (seconds)"""
+    samples = [s for s in samples if s is not None]
+    if not samples:
+        return None
+    return {"n": len(samples),
+            "min": min(samples),
+            "mean": sum(samples) / len(samples),
+            "p50": percentile(samples, 50),
+            "p90": percentile(samples, 90),
+            "p99": percentile(samples, 99),
+            "max": max(samples)}
+
+
+def timeit(fn, repeat=5, number=1, setup=None):
+    """Run fn `number` times per sample, `repeat` samples. Returns the
+    per call latency of each sample, `setup` runs before each sample
+    outside of the timing."""
+    samples = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        for _ in range(number):
+            fn(arg) if setup else fn()
+        samples.append((time.perf_counter() - start) / number)
+    return samples
+
+
+def ms(value):
+    return "-" if value is None else "{:.2f}".format(value * 1000)
+
+
+def save(path, name, params, results):
+    """Write results as JSON along with what they were measured on,
+    so runs can be compared"""
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    data = {"benchmark": name,
+            "time": time.time(),
+            "revision": revision,
+            "python": sys.version,
+            "platform": platform.platform(),
+            "params": params,
+            "results": results}
+    with open(path, "w") as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+    print("Saved {}".format(path))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(",")]
+
+
+def str_list(value):
+    return value.split(",")
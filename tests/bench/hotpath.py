@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Micro benchmarks of the disco hot path.
+
+Times merging, hashing, validation, rule matching, rule evaluation and
+populating knowledge from a source against synthetic knowledge bases
+of each --keys size, e.g.
+
+    python tests/bench/hotpath.py --keys 1000,100000 -o hot.json
+
+Everything runs in process, no network or handlers are involved.
+"""
+import argparse
+import asyncio
+import copy
+
+from common import int_list, ms, save, summarize, timeit
+
+from layer_cake import discovery, reactive, utils
+from layer_cake.knowledge import Knowledge
+
+# Leaves per interface, see knowledge
+LEAVES = 10
+
+
+def knowledge(keys):
+    """Synthetic nested data with about `keys` leaves"""
+    data = {}
+    for i in range(max(1, keys // LEAVES)):
+        data["iface{}".format(i)] = {
+            "host": "10.0.{}.{}".format(i // 250 % 250, i % 250),
+            "port": str(1024 + i % 60000),
+            "meta": {"k{}".format(j): "v{}".format(i * j)
+                     for j in range(LEAVES - 2)}}
+    return data
+
+
+def schema(name, required=("host", "port")):
+    return {"name": name, "type": "object",
+            "properties": {"host": {"type": "string"},
+                           "port": {"type": "string"},
+                           "meta": {"type": "object"}},
+            "required": list(required)}
+
+
+def changed(data, fraction=0.1):
+    """A copy of some of data's interfaces with one leaf changed"""
+    names = sorted(data)[:max(1, int(len(data) * fraction))]
+    return {n: dict(data[n], port="1") for n in names}
+
+
+class MemorySource(discovery.Source):
+    """Source serving whatever state it is given"""
+    def __init__(self, state):
+        super().__init__({"name": "memory"})
+        self.state = state
+
+    async def State(self):
+        return self.state
+
+
+def bench(keys, schemas, rules, repeat):
+    data = knowledge(keys)
+    interfaces = sorted(data)
+    schemas = min(schemas, len(interfaces))
+    overlay = changed(data)
+    results = {}
+
+    def record(name, samples):
+        results[name] = summarize(samples)
+
+    record("knowledge_update", timeit(
+        lambda kb: kb.update(data), repeat, setup=Knowledge))
+    record("deepmerge", timeit(
+        lambda d: utils.deepmerge(d, overlay), repeat,
+        setup=lambda: copy.deepcopy(data)))
+    record("digest", timeit(lambda: utils.digest(data), repeat))
+
+    kb = Knowledge()
+    kb.update(data)
+    for i in range(schemas):
+        kb.update({"schemas": {interfaces[i]: schema(interfaces[i])}})
+
+    def validate_all():
+        for name in interfaces[:schemas]:
+            kb.is_valid(name, name)
+
+    record("is_valid_cold", [t / schemas for t in timeit(
+        lambda _: validate_all(), repeat, setup=kb._valid.clear)])
+    validate_all()
+    record("is_valid_memoized", [t / schemas for t in timeit(
+        validate_all, repeat)])
+
+    ruleset = [reactive.Rule([interfaces[i % schemas]], "handler")
+               for i in range(rules)]
+
+    def match_all():
+        for rule in ruleset:
+            rule.match(kb)
+    record("rule_match", [t / rules for t in timeit(match_all, repeat)])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        r = reactive.Reactive(loop=loop)
+        # Rules never match (a required field is missing) so every
+        # pass evaluates all of them without running handlers
+        for i in range(schemas):
+            r.kb.update({"schemas": {interfaces[i]: schema(
+                interfaces[i], ("host", "port", "user"))}})
+        r.kb.update(data)
+        for i in range(rules):
+            r.add_rule({"rule": {"when": interfaces[i % schemas],
+                                 "do": "handler"}}, 1)
+        record("run_once_full", timeit(
+            lambda: loop.run_until_complete(r.run_once()), repeat))
+
+        def touch():
+            r.kb["{}.port".format(interfaces[0])] = "2"
+            return {interfaces[0]}
+        record("run_once_changed", timeit(
+            lambda c: loop.run_until_complete(r.run_once(c)), repeat,
+            setup=touch))
+
+        discover = discovery.Discover({}, loop=loop)
+        source = MemorySource(data)
+        discover.add_source(source)
+        target = Knowledge()
+        record("populate_initial", timeit(
+            lambda kb: loop.run_until_complete(discover.populate(kb)),
+            repeat, setup=lambda: (setattr(source, "last_state", {}),
+                                   setattr(source, "digests", {}),
+                                   Knowledge())[-1]))
+
+        def update():
+            state = dict(data)
+            state.update(changed(data, 0.01))
+            source.state = state
+            return target
+        loop.run_until_complete(discover.populate(target))
+        record("populate_changed", timeit(
+            lambda kb: loop.run_until_complete(discover.populate(kb)),
+            repeat, setup=update))
+    finally:
+        loop.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--keys", type=int_list, default=[1000, 10000],
+                        help="Knowledge base sizes (leaves)")
+    parser.add_argument("--schemas", type=int, default=100)
+    parser.add_argument("--rules", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("-o", "--output", help="Save results as JSON")
+    options = parser.parse_args()
+
+    print("{:<20}{:>9}{:>10}{:>10}{:>10}{:>12}".format(
+          "benchmark", "keys", "p50 ms", "p90 ms", "p99 ms", "ops/s"))
+    results = {}
+    for keys in options.keys:
+        results[keys] = bench(keys, options.schemas, options.rules,
+                              options.repeat)
+        for name, summary in results[keys].items():
+            print("{:<20}{:>9}{:>10}{:>10}{:>10}{:>12.0f}".format(
+                  name, keys, ms(summary["p50"]), ms(summary["p90"]),
+                  ms(summary["p99"]), 1 / summary["mean"]))
+    if options.output:
+        save(options.output, "hotpath", vars(options), results)
+
+
+if __name__ == "__main__":
+    main()
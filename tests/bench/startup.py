@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Startup (import) time of the disco entry point.
+
+Runs `python -X importtime` importing layer_cake.disco and configuring
+discovery for --source, --repeat times, and prints the median time
+along with the slowest imports. Before Python 3.7, which has no
+-X importtime, the imports are timed as a whole with the wall clock.
+Exits non zero when the median is over --target-ms (default 150, 0 to
+only report), e.g.
+
+    python tests/bench/startup.py --source flat --target-ms 150 -o start.json
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+from common import environ, save, summarize
+
+SCRIPT = """
+from layer_cake import disco, discovery
+discovery.Discover({{{source!r}: {{}}}} if {source!r} else {{}})
+"""
+
+# Wall clock timing where -X importtime isn't available
+TIMED = """
+import time
+start = time.perf_counter()
+{script}
+print(time.perf_counter() - start)
+"""
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def importtime(source):
+    """Run one interpreter, returning the import time of each top level
+    import as {module: (self, cumulative)} in seconds"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         SCRIPT.format(source=source)],
+        env=environ(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.decode("utf-8", "replace"))
+    modules = {}
+    for line in proc.stderr.decode("utf-8").splitlines():
+        match = LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            modules[name] = (int(own) / 1e6, int(cumulative) / 1e6,
+                             len(indent) // 2)
+    return modules
+
+
+def wallclock(source):
+    """Run one interpreter, returning the seconds taken by the imports"""
+    proc = subprocess.run(
+        [sys.executable, "-c",
+         TIMED.format(script=SCRIPT.format(source=source))],
+        env=environ(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.decode("utf-8", "replace"))
+    return float(proc.stdout.decode("utf-8").split()[-1])
+
+
+def total(modules):
+    """Time of the top level imports from layer_cake.disco on, leaving
+    out interpreter startup"""
+    seconds, started = 0, False
+    for name, (own, cumulative, depth) in modules.items():
+        started = started or name.startswith("layer_cake")
+        if started and depth == 0:
+            seconds += cumulative
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--source", default="flat",
+                        help="Source to configure, empty for none")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--target-ms", type=float, default=150,
+                        help="Fail when the median is above this, 0 to "
+                             "only report")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of slowest imports to show")
+    parser.add_argument("-o", "--output", help="Save results as JSON")
+    options = parser.parse_args()
+
+    if sys.version_info >= (3, 7):
+        runs = [importtime(options.source) for _ in range(options.repeat)]
+        totals = [total(run) for run in runs]
+    else:
+        runs = [{}]
+        totals = [wallclock(options.source) for _ in range(options.repeat)]
+    summary = summarize(totals)
+    slowest = sorted(runs[-1].items(), key=lambda i: i[1][0],
+                     reverse=True)[:options.top]
+
+    print("startup p50 {:.1f}ms p90 {:.1f}ms ({} runs, source {!r})".format(
+          summary["p50"] * 1000, summary["p90"] * 1000, options.repeat,
+          options.source))
+    if slowest:
+        print("slowest imports (self ms):")
+        for name, (own, cumulative, depth) in slowest:
+            print("  {:>8.2f}  {}".format(own * 1000, name))
+    else:
+        print("no per module times, -X importtime needs Python 3.7")
+    if options.output:
+        save(options.output, "startup", vars(options),
+             {"summary": summary,
+              "modules": sorted(runs[-1]),
+              "slowest": [[name, own] for name, (own, c, d) in slowest]})
+    if options.target_ms and summary["p50"] * 1000 > options.target_ms:
+        print("Over the {}ms target".format(options.target_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import tempfile
+import unittest
+
+import requests
+
+from utils import FakeLayerAPI
+
+from layer_cake import api
+from layer_cake import cake
+
+
+class TestMetadataClient(unittest.TestCase):
+    def test_cached(self):
+        layer = {"id": "mine", "repo": "file:///tmp/mine"}
+        td = tempfile.TemporaryDirectory()
+        self.addCleanup(td.cleanup)
+        with FakeLayerAPI({"/api/v2/layers/mine": layer}) as server:
+            client = api.MetadataClient(td.name, ttl=60, retries=0)
+            for i in range(2):
+                self.assertEqual(cake.layer_get_metadata(
+                    "mine", api=server.url, client=client), layer)
+            # The second lookup is within the TTL
+            self.assertEqual(server.requests, [("/api/v2/layers/mine", 200)])
+
+            # Past the TTL the cached response is revalidated
+            client = api.MetadataClient(td.name, ttl=0, retries=0)
+            self.assertEqual(client.get(server.url + "/api/v2/layers/mine"),
+                             layer)
+            self.assertEqual(server.requests[-1],
+                             ("/api/v2/layers/mine", 304))
+            with self.assertRaises(ValueError):
+                cake.layer_get_metadata("other", api=server.url,
+                                        client=client)
+            url = server.url
+
+        # Unreachable, the cached response is used
+        self.assertEqual(client.get(url + "/api/v2/layers/mine"), layer)
+        offline = api.MetadataClient(client.cache_dir, offline=True)
+        self.assertEqual(offline.get(url + "/api/v2/layers/mine"), layer)
+        with self.assertRaises(api.Offline):
+            offline.get(url + "/api/v2/layers/other")
+        with self.assertRaises(requests.RequestException):
+            client.get(url + "/api/v2/layers/other")
@@ -1,22 +1,221 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 
+from pathlib import Path
+from unittest import mock
+
 from utils import local_file, Environ, O
 
 from layer_cake import cake
 from layer_cake import constants
+from layer_cake.utils import digest
+from layer_cake.cache import LayerCache
+from layer_cake.cakepath import CakePath, SegmentIndex
 
 
 class TestCake(unittest.TestCase):
     def test_layer_from_path(self):
-        with Environ(CAKE_PATH="tests"):
+        with tempfile.TemporaryDirectory() as td, \
+                Environ(CAKE_PATH="tests", CAKE_CACHE=td):
             c = cake.Cake(O(layer=['disco-layer'],
-                            directory="/tmp",
+                            directory=td,
                             force=False,
                             layer_endpoint="fake"
                             ))
             c.fetch_all()
             assert "disco-layer" in c.layers
 
+    def test_layer_deps(self):
+        with tempfile.TemporaryDirectory() as td:
+            for name, deps in [("a", ["b", "c"]), ("b", ["c"]), ("c", [])]:
+                layerdir = Path(td) / name
+                layerdir.mkdir()
+                (layerdir / "layer.yaml").write_text(
+                    "layer: {{name: {}, layers: {}}}".format(name, deps))
+            with Environ(CAKE_PATH=td, CAKE_CACHE=str(Path(td) / "cache")):
+                c = cake.Cake(O(layer=['a'],
+                                directory=td,
+                                force=False,
+                                layer_endpoint="fake",
+                                jobs=2
+                                ))
+                c.fetch_all()
+            self.assertEqual(list(c.layers), ["c", "b", "a"])
+            self.assertEqual(c.dependencies["a"], ["b", "c"])
+
+    def test_install(self):
+        with tempfile.TemporaryDirectory() as td:
+            record = Path(td) / "record"
+            for name, deps in [("a", ["b"]), ("b", []), ("c", [])]:
+                layerdir = Path(td) / "path" / name
+                layerdir.mkdir(parents=True)
+                (layerdir / "layer.yaml").write_text(
+                    "layer: {{name: {}, layers: {}}}".format(name, deps))
+                installer = layerdir / "install"
+                installer.write_text(
+                    "#!/bin/sh\necho {0} start >> {1}\nsleep 0.2\n"
+                    "echo {0} done >> {1}\n".format(name, record))
+                installer.chmod(0o755)
+            with Environ(CAKE_PATH=str(Path(td) / "path"),
+                         CAKE_CACHE=str(Path(td) / "cache")):
+                c = cake.Cake(O(layer=['a', 'c'],
+                                directory=td,
+                                force=False,
+                                layer_endpoint="fake",
+                                jobs=2
+                                ))
+                c.fetch_all()
+            c.install(Path(td) / "out")
+            events = record.read_text().split("\n")
+            # a includes b so waits for it, c runs alongside b
+            self.assertLess(events.index("b done"), events.index("a start"))
+            self.assertLess(events.index("c start"), events.index("b done"))
+            self.assertEqual(sorted(c.timings), ["a", "b", "c"])
+            self.assertTrue((Path(td) / "out" / "a" / "layer.yaml").exists())
+
+    def test_cakepath_index(self):
+        with tempfile.TemporaryDirectory() as td:
+            first, second = Path(td) / "first", Path(td) / "second"
+            for segment, name in [(first, "a"), (first, "b"), (second, "b")]:
+                layerdir = segment / name
+                layerdir.mkdir(parents=True)
+                (layerdir / "layer.yaml").write_text(
+                    "layer: {{name: {}}}".format(name))
+            cache = LayerCache(Path(td) / "cache")
+            index = cache.indexes
+            path = CakePath([str(first), str(second)], index)
+            self.assertEqual(path.find("a"), first / "a")
+            # Later segments win
+            self.assertEqual(path.find("b"), second / "b")
+            self.assertIsNone(path.find("c"))
+            self.assertEqual(len(list(index.iterdir())), 2)
+
+            # A fresh lookup reuses the stored index without parsing
+            path = CakePath([str(first), str(second)], index)
+            with mock.patch.object(SegmentIndex, "_parse") as parse:
+                self.assertEqual(path.find("a"), first / "a")
+                self.assertFalse(parse.called)
+
+            # Changes to the segment are picked up
+            (first / "c").mkdir()
+            (first / "c" / "layer.yaml").write_text("layer: {name: c}")
+            self.assertEqual(path.find("c"), first / "c")
+            (first / "a" / "layer.yaml").write_text("layer: {name: d}")
+            os.utime(str(first / "a" / "layer.yaml"), (0, 0))
+            self.assertIsNone(path.find("a"))
+            self.assertEqual(path.find("d"), first / "a")
+            self.assertEqual(sorted(path.layers()), ["b", "c", "d"])
+
+            # Indexes are cache entries, evicted once their segment is gone
+            self.assertEqual([e["kind"] for e in cache.entries()],
+                             ["index", "index"])
+            shutil.rmtree(str(second))
+            evicted = cache.prune()
+            self.assertEqual([e["segment"] for e in evicted],
+                             [str(second.resolve())])
+            self.assertEqual(len(cache.entries()), 1)
+
+    def test_layer_fetch(self):
+        with tempfile.TemporaryDirectory() as td:
+            repo = Path(td) / "repo"
+            (repo / "layers" / "mine").mkdir(parents=True)
+            (repo / "other").mkdir()
+            (repo / "layers" / "mine" / "layer.yaml").write_text(
+                "layer: {name: mine}")
+            (repo / "other" / "big").write_text("x")
+
+            def git(*cmd):
+                return subprocess.check_output(
+                    ["git", "-c", "user.name=t", "-c", "user.email=t@t",
+                     *cmd], cwd=str(repo)).decode("utf-8").strip()
+            git("init", "-q")
+            git("add", ".")
+            git("commit", "-q", "-m", "one")
+            commit = git("rev-parse", "HEAD")
+            (repo / "layers" / "mine" / "later").write_text("y")
+            git("add", ".")
+            git("commit", "-q", "-m", "two")
+
+            layer = cake.Layer({"id": "mine", "repo": "file://" + str(repo),
+                                "repopath": "/layers/mine",
+                                "commit": commit})
+            (Path(td) / "out").mkdir()
+            layer.fetch(Path(td) / "out")
+            self.assertEqual(layer.commit, commit)
+            self.assertEqual(layer.name, "mine")
+            self.assertFalse((layer.dir / "later").exists())
+
+    def test_layer_cache(self):
+        with tempfile.TemporaryDirectory() as td:
+            repo = Path(td) / "repo"
+            (repo / "layers" / "mine").mkdir(parents=True)
+            (repo / "layers" / "mine" / "layer.yaml").write_text(
+                "layer: {name: mine}")
+            subprocess.check_call(["git", "init", "-q"], cwd=str(repo))
+            subprocess.check_call(["git", "add", "."], cwd=str(repo))
+            subprocess.check_call(
+                ["git", "-c", "user.name=t", "-c", "user.email=t@t",
+                 "commit", "-q", "-m", "one"], cwd=str(repo))
+            metadata = {"id": "mine", "repo": "file://" + str(repo),
+                        "repopath": "/layers/mine"}
+            c = LayerCache(Path(td) / "cache")
+            first = cake.Layer(metadata)
+            first.fetch(Path(td) / "one", cache=c)
+            self.assertEqual(first.name, "mine")
+            # Without the repo only an offline fetch is served from the
+            # cache, rather than silently using what may be stale
+            shutil.rmtree(str(repo))
+            with self.assertRaises(OSError):
+                cake.Layer(metadata).fetch(Path(td) / "two", cache=c)
+            c.offline = True
+            second = cake.Layer(metadata)
+            second.fetch(Path(td) / "two", cache=c)
+            self.assertEqual(second.commit, first.commit)
+            # Copies unless asked for hard links
+            self.assertNotEqual(
+                (first.dir / "layer.yaml").stat().st_ino,
+                (second.dir / "layer.yaml").stat().st_ino)
+            third = cake.Layer(metadata)
+            third.fetch(Path(td) / "three", cache=c, link=True)
+            fourth = cake.Layer(metadata)
+            fourth.fetch(Path(td) / "four", cache=c, link=True)
+            self.assertEqual(
+                (third.dir / "layer.yaml").stat().st_ino,
+                (fourth.dir / "layer.yaml").stat().st_ino)
+            self.assertEqual([e["kind"] for e in c.entries()],
+                             ["mirror", "tree"])
+            evicted = c.prune(0)
+            self.assertEqual(len(evicted), 2)
+            self.assertEqual(c.entries(), [])
+
+    def test_mirror_lock(self):
+        with tempfile.TemporaryDirectory() as td:
+            c = LayerCache(Path(td))
+            path = c.mirrors / (digest("repo") + ".git")
+            path.mkdir(parents=True)
+            running, overlapped = [], []
+
+            def git(*cmd, cwd=None):
+                running.append(cmd)
+                overlapped.append(len(running) > 1)
+                time.sleep(0.05)
+                running.remove(cmd)
+
+            with mock.patch.object(c, "_git", git):
+                threads = [threading.Thread(target=c.mirror, args=("repo",))
+                           for _ in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            # Every thread fetched, one at a time
+            self.assertEqual(overlapped, [False] * 4)
+
     def test_layer(self):
         layer = cake.Layer.from_path(local_file('disco_layer'))
         assert layer.name == "disco-layer"
@@ -1,9 +1,18 @@
 import asyncio
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
-from utils import local_file, Environ
+from unittest import mock
 
-from layer_cake import discovery
+from aioconsul.exceptions import HTTPError
+from utils import local_file, Environ, FakeConsul, FakeEtcd
+
+from layer_cake.consul import ConsulSource
+from layer_cake.etcd import Etcd
+from layer_cake import discovery, flatfile, metrics
 from layer_cake.disco import configure_from_env
 from layer_cake.knowledge import Knowledge
 
@@ -27,3 +36,367 @@ class TestDiscovery(unittest.TestCase):
             kb = Knowledge()
             self.loop.run_until_complete(d.populate(kb))
             self.assertEqual(kb['mysql.host'], "localhost:3306")
+
+    def test_consul_watch(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        with FakeConsul({"mysql/host": "a", "other/key": 1}) as consul:
+            source = ConsulSource({
+                "host": consul.url, "prefix": "mysql", "wait": "2s"})
+            self.loop.run_until_complete(source.connect())
+            state = self.loop.run_until_complete(source.watch(None))
+            self.assertEqual(state, {"mysql": {"host": "a"}})
+            watch = self.loop.create_task(source.watch(None))
+            self.loop.call_later(0.1, consul.put, "mysql/host", "b")
+            state = self.loop.run_until_complete(watch)
+            self.assertEqual(state, {"mysql": {"host": "b"}})
+            # The second request was a blocking query
+            self.assertEqual(consul.requests[1][1]["index"], ["1"])
+
+    def test_consul_watch_scoped(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        with FakeConsul({"a/k": "1", "b/k": "1"}) as consul:
+            source = ConsulSource({"host": consul.url, "wait": "5s"})
+            source.scope = {"a", "b"}
+            self.loop.run_until_complete(source.connect())
+            self.loop.run_until_complete(source.watch(None))
+            for key, value in (("b/k", "2"), ("a/k", "2"), ("b/k", "3")):
+                watch = self.loop.create_task(source.watch(None))
+                self.loop.call_later(0.1, consul.put, key, value)
+                self.loop.run_until_complete(watch)
+            self.assertEqual(watch.result(), {"a": {"k": "2"},
+                                              "b": {"k": "3"}})
+            # Only the query that returned with a change is sent again
+            reads = [path for path, q in consul.requests if "index" in q]
+            self.assertEqual(reads.count("/v1/kv/a"), 2)
+            self.assertEqual(reads.count("/v1/kv/b"), 2)
+            self.loop.run_until_complete(source.disconnect())
+
+    def test_etcd_watch(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+
+        def watch():
+            return loop.run_until_complete(
+                asyncio.wait_for(source.watch(None), 5))
+
+        with FakeEtcd({"mysql/host": "a"}, history=3) as etcd:
+            # The watched data last changed longer ago than etcd's
+            # history reaches
+            for i in range(5):
+                etcd.put("other/k", i)
+            source = Etcd({"host": "127.0.0.1", "port": etcd.port})
+            source.scope = {"mysql", "pgsql"}
+            loop.run_until_complete(source.connect())
+            self.addCleanup(loop.run_until_complete, source.disconnect())
+            self.assertEqual(watch(), {"mysql": {"host": "a"}})
+
+            loop.call_later(0.05, etcd.put, "mysql/port", 3306)
+            self.assertEqual(watch(), {"mysql": {"host": "a",
+                                                 "port": "3306"}})
+            loop.call_later(0.05, etcd.delete, "mysql/host")
+            self.assertEqual(watch(), {"mysql": {"port": "3306"}})
+            loop.call_later(0.05, etcd.put, "pgsql/host", "b")
+            self.assertEqual(watch(), {"mysql": {"port": "3306"},
+                                       "pgsql": {"host": "b"}})
+            # Only the scoped interfaces are watched, never the root
+            watched = {path for path, q in etcd.requests if "wait" in q}
+            self.assertEqual(watched, {"/v2/keys/mysql", "/v2/keys/pgsql"})
+
+            # Watching from an index etcd no longer has rereads, once
+            source._cancel()
+            etcd.history = 1
+            etcd.put("other/k", "x")
+            etcd.put("mysql/port", 3307)
+            reads = len(etcd.requests)
+            self.assertEqual(watch(), {"mysql": {"port": "3307"},
+                                       "pgsql": {"host": "b"}})
+            self.assertEqual(
+                sorted(path for path, q in etcd.requests[reads:]
+                       if "wait" not in q),
+                ["/v2/keys/mysql", "/v2/keys/pgsql"])
+            loop.call_later(0.05, etcd.put, "pgsql/host", "c")
+            self.assertEqual(watch()["pgsql"], {"host": "c"})
+
+    def test_backoff(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+
+        class Flaky(discovery.Source):
+            failures = 4
+            disconnects = 0
+
+            async def State(self):
+                if self.failures:
+                    self.failures -= 1
+                    raise OSError("down")
+                return {"mysql": {"host": "a"}}
+
+            async def disconnect(self):
+                self.disconnects += 1
+
+        d = discovery.Discover({"disco": {"interval": 1}}, loop=loop)
+        d.max_backoff = 4
+        source = Flaky({"name": "flaky"})
+        d.add_source(source)
+        kb = Knowledge()
+
+        def populate():
+            loop.run_until_complete(d.populate(kb))
+            return d._retry.get("flaky", loop.time()) - loop.time()
+
+        self.assertAlmostEqual(populate(), 1, delta=0.1)
+        self.assertEqual(source.disconnects, 1)
+        self.assertFalse(source.connected)
+        # Not polled again until the delay passed
+        populate()
+        self.assertEqual(source.failures, 3)
+        # Each failure doubles the delay, up to max_backoff
+        for delay in (2, 4, 4):
+            d._retry["flaky"] = loop.time()
+            self.assertAlmostEqual(populate(), delay, delta=0.1)
+        self.assertEqual(source.disconnects, 4)
+
+        d._retry["flaky"] = loop.time()
+        populate()
+        self.assertEqual(kb["mysql.host"], "a")
+        self.assertEqual((d._failures, d._retry), ({}, {}))
+        # Recovering starts the backoff over
+        source.failures = 1
+        self.assertAlmostEqual(populate(), 1, delta=0.1)
+
+    def test_poll_concurrent(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        events = []
+
+        class Delayed(discovery.Source):
+            async def State(self):
+                events.append(("start", self.name))
+                await asyncio.sleep(self.config["delay"])
+                events.append(("end", self.name))
+                return {"mysql": {"host": self.name}}
+
+        d = discovery.Discover({}, loop=loop)
+        for name, delay in (("a", 0.1), ("b", 0), ("slow", 5)):
+            d.add_source(Delayed({"name": name, "delay": delay,
+                                  "timeout": 0.3}))
+        kb = Knowledge()
+        start = loop.time()
+        loop.run_until_complete(d.populate(kb))
+        # Polled together, the slow source only costs its timeout
+        self.assertLess(loop.time() - start, 1)
+        self.assertEqual(events[:3], [("start", "a"), ("start", "b"),
+                                      ("start", "slow")])
+        self.assertEqual(events[3:], [("end", "b"), ("end", "a")])
+        self.assertEqual(d._failures, {"slow": 1})
+        self.assertIn("slow", d._retry)
+        # b finished first but comes later in the configuration
+        self.assertEqual(kb["mysql.host"], "b")
+
+    def test_follow_timeout(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+
+        class Hung(discovery.PushSource):
+            async def watch(self, spec=None):
+                await asyncio.sleep(60)
+
+        d = discovery.Discover({"disco": {"interval": 5}}, loop=loop)
+        source = Hung({"name": "hung", "timeout": 0.1})
+        d.add_source(source)
+        registry = metrics.Metrics()
+        with mock.patch.object(metrics, "timer", registry.timer):
+            task = loop.create_task(d.watch(Knowledge()))
+            loop.run_until_complete(asyncio.sleep(0.3))
+        # The first read timed out and the source is backing off
+        self.assertEqual(d._failures, {"hung": 1})
+        self.assertFalse(source.connected)
+        self.assertIn(("source_state", (("source", "hung"),)),
+                      registry.histograms)
+        loop.run_until_complete(d.shutdown())
+        loop.run_until_complete(task)
+
+    def test_learn_precedence(self):
+        d = discovery.Discover({})
+        first = discovery.Source({"name": "first"})
+        second = discovery.Source({"name": "second"})
+        d.add_source(first)
+        d.add_source(second)
+        kb = Knowledge()
+        d.learn(first, {"mysql": {"host": "a", "port": 1}}, kb)
+        d.learn(second, {"mysql": {"host": "b"}}, kb)
+        d.learn(first, {"mysql": {"host": "c", "port": 1}}, kb)
+        self.assertEqual(kb["mysql.host"], "b")
+        # Removals fall back to the earlier source
+        d.learn(second, {}, kb)
+        self.assertEqual(kb["mysql"], {"host": "c", "port": 1})
+        d.learn(first, {}, kb)
+        self.assertNotIn("mysql", kb)
+
+    def test_consul_scoped(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        with FakeConsul({"mysql/host": "a", "mysqlx/host": "b",
+                         "pgsql/host": "c", "other/key": 1}) as consul:
+            d = discovery.Discover({"consul": {"host": consul.url}},
+                                   interfaces=["mysql", "pgsql"])
+            kb = Knowledge()
+            self.loop.run_until_complete(d.populate(kb))
+            self.assertEqual(dict(kb), {"mysql": {"host": "a"},
+                                        "pgsql": {"host": "c"}})
+            # Both interfaces are fetched in one transaction
+            self.assertEqual([path for path, q in consul.requests],
+                             ["/v1/txn"])
+
+    def test_consul_txn(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        with FakeConsul({"a/k": 1, "b/k": 2, "c/k": 3},
+                        txn_ops=2) as consul:
+            source = ConsulSource({"host": consul.url,
+                                             "txn_ops": 2})
+            source.scope = {"a", "b", "c"}
+            self.loop.run_until_complete(source.connect())
+            state = self.loop.run_until_complete(source.State())
+            self.assertEqual(state, {"a": {"k": "1"}, "b": {"k": "2"},
+                                     "c": {"k": "3"}})
+            # One batched read of a and b, c needs another transaction
+            self.assertEqual([path for path, q in consul.requests],
+                             ["/v1/txn", "/v1/txn"])
+
+            consul.txn_ops = 1
+            state = self.loop.run_until_complete(source.State())
+            self.assertEqual(len(state), 3)
+            # Refused, falls back to one read per prefix
+            self.assertEqual(sorted(path for path, q in consul.requests[3:]),
+                             ["/v1/kv/a", "/v1/kv/b", "/v1/kv/c"])
+
+    def test_consul_txn_error(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        with FakeConsul({"a/k": 1, "b/k": 2}) as consul:
+            source = ConsulSource({"host": consul.url})
+            source.scope = {"a", "b"}
+            self.loop.run_until_complete(source.connect())
+            # A server error fails the poll but keeps using transactions
+            consul.txn_status = 500
+            with self.assertRaises(HTTPError):
+                self.loop.run_until_complete(source.State())
+            self.assertTrue(source._use_txn)
+            consul.txn_status = None
+            state = self.loop.run_until_complete(source.State())
+            self.assertEqual(state, {"a": {"k": "1"}, "b": {"k": "2"}})
+            self.assertEqual([path for path, q in consul.requests],
+                             ["/v1/txn", "/v1/txn"])
+
+    def test_lazy_backends(self):
+        # Only the configured backends and their clients are imported
+        script = (
+            "import sys\n"
+            "from layer_cake import disco, discovery\n"
+            "d = discovery.Discover({'flat': {'file': 'x'}})\n"
+            "print(' '.join(sorted(m for m in ('aiohttp', 'aioconsul', "
+            "'aio_etcd', 'jsonschema', 'layer_cake.consul', "
+            "'layer_cake.etcd') if m in sys.modules)))\n")
+        output = subprocess.check_output([sys.executable, "-c", script])
+        self.assertEqual(output.decode("utf-8").split(), [])
+        self.assertIs(discovery.source_class("consul"), ConsulSource)
+        # Still importable from where they used to be
+        self.assertIs(discovery.ConsulSource, ConsulSource)
+        with self.assertRaises(ValueError):
+            discovery.source_class("nope")
+
+    def test_source_plugin(self):
+        class Sidecar(discovery.PushSource):
+            pass
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        entry_point = mock.Mock()
+        entry_point.load.return_value = Sidecar
+        self.addCleanup(discovery.SOURCES.pop, "sidecar", None)
+        with mock.patch.object(discovery, "_entry_points",
+                               return_value={"sidecar": entry_point}):
+            d = discovery.Discover({"sidecar": {}})
+        self.assertIsInstance(d.sources[0], Sidecar)
+        self.assertIs(d.sources[0].loop, loop)
+
+        # Pushed states are learned as they arrive
+        kb = Knowledge()
+        task = loop.create_task(d.watch(kb))
+        loop.call_later(0.05, d.sources[0].push, {"mysql": {"host": "a"}})
+        loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(kb["mysql.host"], "a")
+        loop.run_until_complete(d.shutdown())
+        loop.run_until_complete(task)
+
+    def _flat_watch(self, td):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+
+        def write(name, text):
+            # Written aside then renamed into place, as sidecars do
+            tmp = os.path.join(td, ".{}.tmp".format(name))
+            with open(tmp, "w") as fp:
+                fp.write(text)
+            os.rename(tmp, os.path.join(td, name))
+
+        write("a.yaml", "mysql:\n  host: a\n")
+        write("b.yaml", "mysql:\n  port: '1'\n")
+        source = flatfile.FlatFile({"file": td, "interval": 0.01})
+        loop.run_until_complete(source.connect())
+        self.addCleanup(loop.run_until_complete, source.disconnect())
+        state = loop.run_until_complete(source.watch(None))
+        self.assertEqual(state, {"mysql": {"host": "a", "port": "1"}})
+
+        # Only the file that changed is parsed again
+        with mock.patch.object(source, "_parse",
+                               wraps=source._parse) as parse:
+            watch = loop.create_task(source.watch(None))
+            loop.call_later(0.05, write, "b.yaml", "mysql:\n  port: '2'\n")
+            state = loop.run_until_complete(
+                asyncio.wait_for(watch, 5))
+            self.assertEqual(state, {"mysql": {"host": "a", "port": "2"}})
+            self.assertEqual(parse.call_args_list,
+                             [mock.call(os.path.join(td, "b.yaml"))])
+            loop.run_until_complete(source.State())
+            self.assertEqual(parse.call_count, 1)
+
+    def test_flat_file_watch(self):
+        with tempfile.TemporaryDirectory() as td:
+            self._flat_watch(td)
+
+    def test_flat_file_poll(self):
+        with tempfile.TemporaryDirectory() as td, \
+                mock.patch.object(flatfile, "inotify", return_value=None):
+            self._flat_watch(td)
+
+    def test_flat_file_not_mapping(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        with tempfile.TemporaryDirectory() as td:
+            for name, text in (("a.yaml", "- 1\n- 2\n"), ("b.yaml", "x\n"),
+                               ("c.yaml", "mysql:\n  host: a\n")):
+                with open(os.path.join(td, name), "w") as fp:
+                    fp.write(text)
+            source = flatfile.FlatFile({"file": td})
+            loop.run_until_complete(source.connect())
+            self.addCleanup(loop.run_until_complete, source.disconnect())
+            # Lists and scalars are skipped rather than failing the merge
+            with self.assertLogs("disco", "WARNING"):
+                state = loop.run_until_complete(source.watch(None))
+            self.assertEqual(state, {"mysql": {"host": "a"}})
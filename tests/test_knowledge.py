@@ -2,6 +2,7 @@ import unittest
 
 from utils import local_stream
 from layer_cake.knowledge import Knowledge
+from layer_cake.utils import DELETED
 
 
 class TestKnowledge(unittest.TestCase):
@@ -10,3 +11,46 @@ class TestKnowledge(unittest.TestCase):
         kb.load(local_stream("mysql.yaml"))
         kb.load_schema(local_stream("interface-mysql.schema"))
         kb.validate("mysql", "mysql")
+
+    def test_validator_cached(self):
+        kb = Knowledge()
+        kb.load(local_stream("mysql.yaml"))
+        kb.load_schema(local_stream("interface-mysql.schema"))
+        validator = kb.validator("mysql")
+        self.assertIs(kb.validator("mysql"), validator)
+        kb.load_schema(local_stream("interface-mysql.schema"))
+        self.assertIsNot(kb.validator("mysql"), validator)
+
+    def test_is_valid_memoized(self):
+        kb = Knowledge()
+        kb.load_schema(local_stream("interface-mysql.schema"))
+        self.assertFalse(kb.is_valid("mysql", "mysql"))
+        kb.load(local_stream("mysql.yaml"))
+        self.assertTrue(kb.is_valid("mysql", "mysql"))
+        version = kb.fingerprint("mysql")
+        kb["other.key"] = 1
+        self.assertEqual(kb.fingerprint("mysql"), version)
+        kb["mysql.host"] = 3306
+        self.assertNotEqual(kb.fingerprint("mysql"), version)
+        self.assertFalse(kb.is_valid("mysql", "mysql"))
+
+    def test_subscribe(self):
+        kb = Knowledge()
+        changes = []
+        kb.subscribe(changes.append)
+        kb.load(local_stream("mysql.yaml"))
+        kb["other.key"] = 1
+        kb.load_schema(local_stream("interface-mysql.schema"))
+        self.assertEqual(changes, [{"mysql"}, {"other"}, {"schemas", "mysql"}])
+
+    def test_apply_diff(self):
+        kb = Knowledge()
+        kb.load(local_stream("mysql.yaml"))
+        changes = []
+        kb.subscribe(changes.append)
+        kb.apply_diff([(("mysql", "host"), "db:3306"),
+                       (("pgsql", "host"), "pg")])
+        self.assertEqual(kb["mysql.host"], "db:3306")
+        self.assertEqual(changes, [{"mysql", "pgsql"}])
+        kb.apply_diff([(("pgsql", "host"), DELETED)])
+        self.assertNotIn("pgsql", kb)
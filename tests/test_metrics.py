@@ -0,0 +1,82 @@
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+from unittest import mock
+
+from layer_cake import metrics
+from layer_cake.knowledge import Knowledge
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_sinks(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        logger = mock.Mock()
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, "disco.prom")
+            metrics.configure({"disco": {
+                "metrics": "json,prometheus,statsd",
+                "metrics_path": path,
+                "statsd": "127.0.0.1:{}".format(
+                    receiver.getsockname()[1])}}, self.metrics)
+            self.metrics.sinks[0].logger = logger
+            self.metrics.observe("source_state", 0.02, source="consul")
+            self.metrics.incr("source_errors", source="consul")
+            self.assertEqual(receiver.recv(1024),
+                             b"disco.source_state.source_consul:20.000|ms")
+            self.assertEqual(receiver.recv(1024),
+                             b"disco.source_errors.source_consul:1|c")
+            self.metrics.flush()
+            with open(path) as fp:
+                prom = fp.read().splitlines()
+
+        self.assertIn('disco_source_errors_total{source="consul"} 1', prom)
+        self.assertIn('disco_source_state_seconds_bucket'
+                      '{source="consul",le="0.01"} 0', prom)
+        self.assertIn('disco_source_state_seconds_bucket'
+                      '{source="consul",le="0.025"} 1', prom)
+        self.assertIn('disco_source_state_seconds_bucket'
+                      '{source="consul",le="+Inf"} 1', prom)
+        self.assertIn('disco_source_state_seconds_count'
+                      '{source="consul"} 1', prom)
+        fmt, line = logger.info.call_args[0]
+        data = json.loads(line)
+        self.assertEqual(data["timers"][0]["name"], "source_state")
+        self.assertEqual(data["timers"][0]["count"], 1)
+        self.assertEqual(data["counters"][0]["value"], 1)
+
+    def test_prometheus_type_once(self):
+        for source in ("consul", "etcd"):
+            self.metrics.incr("source_errors", source=source)
+            self.metrics.observe("source_state", 0.02, source=source)
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, "disco.prom")
+            metrics.PrometheusSink(path).flush(self.metrics)
+            with open(path) as fp:
+                prom = fp.read().splitlines()
+        types = [line for line in prom if line.startswith("# TYPE")]
+        self.assertEqual(types, [
+            "# TYPE disco_source_errors_total counter",
+            "# TYPE disco_source_state_seconds histogram"])
+        self.assertIn('disco_source_errors_total{source="etcd"} 1', prom)
+
+    def test_validation_timed(self):
+        kb = Knowledge()
+        kb.update({"schemas": {"mysql": {
+            "type": "object", "required": ["host"]}}})
+        kb["mysql.host"] = "db"
+        with mock.patch.object(metrics, "timer", self.metrics.timer):
+            self.assertTrue(kb.is_valid("mysql", "mysql"))
+            # Memoized, not validated again
+            self.assertTrue(kb.is_valid("mysql", "mysql"))
+        histogram = self.metrics.histograms[
+            ("validation", (("interface", "mysql"),))]
+        self.assertEqual(histogram.count, 1)
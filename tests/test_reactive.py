@@ -1,6 +1,9 @@
+import asyncio
 import unittest
 import pkg_resources
 
+from unittest import mock
+
 from utils import local_stream
 
 from layer_cake.knowledge import Knowledge
@@ -27,3 +30,76 @@ class TestReactive(unittest.TestCase):
         r = reactive.Reactive()
         r.load_rules(pkg_resources.resource_stream(__name__, "myapp1.rules"))
         self.assertEqual(len(r.rules), 1)
+
+    def test_run_once_changed(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        r = reactive.Reactive(loop=loop)
+        r.load_rules(pkg_resources.resource_stream(__name__, "myapp1.rules"))
+        r.kb.load_schema(local_stream("interface-mysql.schema"))
+        r.kb.load(local_stream("mysql.yaml"))
+        self.assertEqual(r._changed, {"schemas", "mysql"})
+        # Only rules depending on a changed interface are evaluated
+        self.assertFalse(loop.run_until_complete(r.run_once({"pgsql"})))
+        self.assertEqual(r.rules[0]._fail_ct, 0)
+        self.assertEqual(r.affected({"mysql", "pgsql"}), r.rules)
+        self.assertEqual(r.affected({"pgsql"}), [])
+        loop.close()
+
+    def test_parallel_stops_on_failure(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        r = reactive.Reactive(loop=loop)
+        ran = []
+
+        def handler(name, delay=0, fail=False):
+            async def execute(kb, **kwargs):
+                ran.append(name)
+                await asyncio.sleep(delay)
+                if fail:
+                    raise RuntimeError("fail_limit reached")
+                return True
+            return execute
+
+        rules = {}
+        for name, group in (("bad", "a"), ("slow", "b"), ("later", "b"),
+                            ("queued", "c")):
+            rules[name] = r.add_rule(
+                {"rule": {"when": "mysql", "do": name}}, 1, group)
+        rules["bad"].execute = handler("bad", fail=True)
+        rules["slow"].execute = handler("slow", delay=0.05)
+        rules["later"].execute = handler("later")
+        rules["queued"].execute = handler("queued")
+
+        with self.assertRaises(RuntimeError):
+            loop.run_until_complete(
+                r._execute_parallel(r.rules, 2, fail_limit=1))
+        # The running handler finished, nothing new was started
+        self.assertEqual(ran, ["bad", "slow"])
+
+    def test_run_wakes_on_change(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        r = reactive.Reactive({"disco": {"interval": 30}}, loop=loop)
+        r.load_rules(pkg_resources.resource_stream(__name__, "myapp1.rules"))
+        r.kb.load_schema(local_stream("interface-mysql.schema"))
+        passes = []
+        run_once = r.run_once
+
+        async def record(changed=None):
+            passes.append(changed)
+            if changed:
+                r.shutdown()
+            return await run_once(changed)
+
+        discover = mock.Mock()
+        discover.shutdown.return_value = asyncio.sleep(0)
+        loop.call_later(0.05, r.kb.update,
+                        {"pgsql": {"host": "db", "port": 5432}})
+        with mock.patch.object(r, "run_once", record):
+            loop.run_until_complete(asyncio.wait_for(r.run(discover), 5))
+        # The schema loaded before the full pass isn't evaluated again,
+        # the write is, long before the interval
+        self.assertEqual(passes, [None, {"pgsql"}])
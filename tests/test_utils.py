@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from layer_cake import utils
+
+
+class TestUtils(unittest.TestCase):
+    def test_diff(self):
+        old = {"a": {"b": 1, "c": 2}, "d": 1}
+        new = {"a": {"b": 1, "c": 3, "e": {"f": 1}}}
+        self.assertEqual(sorted(utils.diff(old, new), key=repr), [
+            (("a", "c"), 3),
+            (("a", "e", "f"), 1),
+            (("d",), utils.DELETED),
+            ])
+        self.assertEqual(utils.diff(new, new), [])
+
+    def test_digest(self):
+        a = {"b": [1, "2", None], "c": {"d": {1.5, True}}}
+        b = {"c": {"d": {True, 1.5}}, "b": [1, "2", None]}
+        self.assertEqual(utils.digest(a), utils.digest(b))
+        self.assertNotEqual(utils.digest(a), utils.digest({"b": a["b"]}))
+        self.assertNotEqual(utils.digest([1]), utils.digest(["1"]))
+        self.assertNotEqual(utils.digest(["ab", "c"]),
+                            utils.digest(["a", "bc"]))
+        # Every type has its own tag, in JSON and (with bytes) walked
+        for extra in ([], [b"x"]):
+            self.assertNotEqual(utils.digest(extra + [False]),
+                                utils.digest(extra + [0.0]))
+            self.assertNotEqual(utils.digest(extra + [False, 1.0]),
+                                utils.digest(extra + [0.0, True]))
+            self.assertNotEqual(utils.digest(extra + [False, 1.0]),
+                                utils.digest(extra + [False, 1]))
+            self.assertNotEqual(utils.digest(extra + [{}]),
+                                utils.digest(extra + [0.0]))
+
+    def test_sync_tree(self):
+        with tempfile.TemporaryDirectory() as td:
+            src, dst = Path(td) / "src", Path(td) / "dst"
+            (src / "sub").mkdir(parents=True)
+            (src / "a").write_text("a")
+            (src / "sub" / "b").write_text("b")
+            os.symlink("sub/b", str(src / "link"))
+            with mock.patch.object(utils, "_place",
+                                   wraps=utils._place) as place:
+                utils.sync_tree(src, dst, link=True)
+            self.assertEqual(sorted(place.call_args_list), [
+                mock.call(str(src / "a"), str(dst / "a"), True),
+                mock.call(str(src / "sub" / "b"), str(dst / "sub" / "b"),
+                          True)])
+            self.assertTrue(os.path.samefile(str(src / "a"), str(dst / "a")))
+            self.assertEqual(os.readlink(str(dst / "link")), "sub/b")
+
+            # Copies are updated incrementally
+            utils.sync_tree(src, dst, link=False)
+            self.assertTrue(os.path.samefile(str(src / "a"), str(dst / "a")))
+            (src / "a").unlink()
+            (src / "a").write_text("changed")
+            (dst / "stale").write_text("x")
+            with mock.patch.object(utils, "_place",
+                                   wraps=utils._place) as place:
+                utils.sync_tree(src, dst, link=False)
+                # Only the changed file is placed, once
+                utils.sync_tree(src, dst, link=False)
+            self.assertEqual(place.call_args_list, [
+                mock.call(str(src / "a"), str(dst / "a"), False)])
+            self.assertEqual((dst / "a").read_text(), "changed")
+            self.assertFalse(os.path.samefile(str(src / "a"), str(dst / "a")))
+            self.assertFalse((dst / "stale").exists())
+            self.assertEqual((dst / "sub" / "b").read_text(), "b")
@@ -1,6 +1,14 @@
 from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+import base64
+import json
 import pkg_resources
 import os
+import socketserver
+import sys
+import threading
+import time
 
 
 def local_stream(name):
@@ -28,4 +36,331 @@ def Environ(**kwargs):
 
 class O(dict):
     def __getattr__(self, key):
-        return self[key]
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients going away mid blocking query are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _duration(value, default=300.0):
+    # Consul style durations, 10s, 5m
+    if not value:
+        return default
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    for unit in sorted(units, key=len, reverse=True):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * units[unit]
+    return float(value)
+
+
+class FakeConsul:
+    """Local stand-in for the Consul KV HTTP API.
+
+    Supports recursive reads, blocking queries and get-tree transactions
+    of up to `txn_ops` operations, use `put` and `delete` to change the
+    data from the test. As with Consul a blocking query on a prefix only
+    returns once a key under it changes.
+    """
+    def __init__(self, data=None, txn_ops=64):
+        self.kv = dict(data or {})
+        self.index = 1
+        # key -> index it was last written or deleted at
+        self.modified = dict.fromkeys(self.kv, self.index)
+        self.closed = False
+        # Set to make transactions fail with this status
+        self.txn_status = None
+        self.txn_ops = txn_ops
+        self.requests = []
+        self._cond = threading.Condition()
+        self.server = _ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._handler())
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server.server_address)
+
+    def put(self, key, value):
+        with self._cond:
+            self.kv[key] = value
+            self.index += 1
+            self.modified[key] = self.index
+            self._cond.notify_all()
+
+    def delete(self, key):
+        with self._cond:
+            self.kv.pop(key, None)
+            self.index += 1
+            self.modified[key] = self.index
+            self._cond.notify_all()
+
+    def prefix_index(self, prefix):
+        return max([i for k, i in self.modified.items()
+                    if k.startswith(prefix)] or [self.index])
+
+    def items(self, prefix):
+        return [{"Key": k,
+                 "Value": base64.b64encode(
+                     str(v).encode("utf-8")).decode("ascii"),
+                 "ModifyIndex": self.index}
+                for k, v in sorted(self.kv.items()) if k.startswith(prefix)]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, index=None):
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("X-Consul-Index", str(index or fake.index))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query, keep_blank_values=True)
+                fake.requests.append((url.path, query))
+                prefix = url.path[len("/v1/kv/"):]
+                index = int(query.get("index", ["0"])[0])
+                deadline = time.monotonic() + _duration(
+                    query.get("wait", [""])[0])
+                with fake._cond:
+                    while index and index == fake.prefix_index(prefix) and \
+                            not fake.closed and time.monotonic() < deadline:
+                        fake._cond.wait(deadline - time.monotonic())
+                    items = fake.items(prefix)
+                    index = fake.prefix_index(prefix)
+                self.reply(200 if items else 404, items, index)
+
+            def do_PUT(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                ops = json.loads(body.decode("utf-8"))
+                fake.requests.append((url.path, ops))
+                if url.path != "/v1/txn":
+                    return self.reply(405, None)
+                if fake.txn_status:
+                    return self.reply(fake.txn_status, None)
+                if len(ops) > fake.txn_ops:
+                    return self.reply(413, None)
+                with fake._cond:
+                    results = [{"KV": item} for op in ops
+                               for item in fake.items(op["KV"]["Key"])]
+                self.reply(200, {"Results": results, "Errors": None})
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeLayerAPI:
+    """Local stand-in for the layer metadata API.
+
+    Serves `layers` (path -> JSON body) with an ETag, answering
+    conditional requests with 304 Not Modified.
+    """
+    def __init__(self, layers=None):
+        self.layers = dict(layers or {})
+        self.requests = []
+        self.server = _ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._handler())
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server.server_address)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                etag = self.headers.get("If-None-Match")
+                body = fake.layers.get(url.path)
+                if body is None:
+                    status = 404
+                else:
+                    body = json.dumps(body).encode("utf-8")
+                    tag = '"{}"'.format(hash(body))
+                    status = 304 if etag == tag else 200
+                fake.requests.append((url.path, status))
+                self.send_response(status)
+                if status == 200:
+                    self.send_header("ETag", tag)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeEtcd:
+    """Local stand-in for the etcd v2 keys HTTP API.
+
+    Supports recursive reads and recursive watches from a waitIndex
+    within the last `history` events, use `put` and `delete` to change
+    the data from the test.
+    """
+    def __init__(self, data=None, history=1000):
+        self.kv = {}
+        self.index = 1
+        self.history = history
+        self.closed = False
+        # (index, action, key, value) of every change
+        self.events = []
+        self.requests = []
+        self._cond = threading.Condition()
+        for key, value in sorted((data or {}).items()):
+            self.put(key, value)
+        self.server = _ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._handler())
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server.server_address)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def put(self, key, value):
+        self._change("set", "/" + key.strip("/"), str(value))
+
+    def delete(self, key):
+        self._change("delete", "/" + key.strip("/"), None)
+
+    def _change(self, action, key, value):
+        with self._cond:
+            self.index += 1
+            if value is None:
+                self.kv.pop(key, None)
+            else:
+                self.kv[key] = (value, self.index)
+            self.events.append((self.index, action, key, value))
+            self._cond.notify_all()
+
+    def node(self, key):
+        if key in self.kv:
+            value, index = self.kv[key]
+            return {"key": key, "value": value, "modifiedIndex": index}
+        prefix = key.rstrip("/") + "/"
+        children = {}
+        for k in self.kv:
+            if k.startswith(prefix):
+                child = k[len(prefix):].split("/")[0]
+                children[child] = prefix + child
+        if not children and key != "/":
+            return None
+        nodes = [self.node(k) for _, k in sorted(children.items())]
+        return {"key": key, "dir": True, "nodes": nodes,
+                "modifiedIndex": max([n["modifiedIndex"] for n in nodes] +
+                                     [1])}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body):
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("X-Etcd-Index", str(fake.index))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                fake.requests.append((url.path, query))
+                key = "/" + url.path[len("/v2/keys"):].strip("/")
+                if query.get("wait") == ["true"]:
+                    return self.watch(key, int(query.get("waitIndex",
+                                                         ["0"])[0]))
+                with fake._cond:
+                    node = fake.node(key)
+                if node is None:
+                    return self.reply(404, {"errorCode": 100,
+                                            "message": "Key not found",
+                                            "cause": key,
+                                            "index": fake.index})
+                self.reply(200, {"action": "get", "node": node})
+
+            def watch(self, key, index):
+                prefix = key.rstrip("/") + "/"
+                with fake._cond:
+                    if index and index <= fake.index - fake.history:
+                        return self.reply(400, {
+                            "errorCode": 401,
+                            "message": "The event in requested index "
+                                       "is outdated and cleared",
+                            "index": fake.index})
+                    while True:
+                        for event in fake.events:
+                            if event[0] >= index and (
+                                    event[2] == key or
+                                    event[2].startswith(prefix)):
+                                break
+                        else:
+                            if fake.closed or not fake._cond.wait(300):
+                                return self.reply(200, {})
+                            continue
+                        break
+                i, action, key, value = event
+                node = {"key": key, "modifiedIndex": i}
+                if value is not None:
+                    node["value"] = value
+                self.reply(200, {"action": action, "node": node})
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()